@@ -0,0 +1,58 @@
+from .Fitter import Fitter, FitPoint
+from .FitDiagnostics import FitDiagnostics
+import numpy as np
+from numpy.typing import NDArray
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import os
+
+CHUNKS_PER_WORKER: int = 4
+
+#Calibrations of many datasets with the same polynomial order, stacked along the first axis in the order the datasets were given
+#Fits which failed (e.g. too few points for the order) have NaN parameters and covariances and no diagnostics
+@dataclass
+class BatchCalibrationResult:
+    order: int
+    parameters: NDArray[np.float64] #[fit, parameter]
+    covariances: NDArray[np.float64] #[fit, parameter, parameter], as Fitter.get_parameter_covariance
+    diagnostics: list[Optional[FitDiagnostics]]
+
+    def get_parameter_errors(self) -> NDArray[np.float64]:
+        return np.sqrt(np.diagonal(self.covariances, axis1=1, axis2=2))
+
+    def get_failed_fits(self) -> NDArray[np.int64]:
+        return np.flatnonzero(np.any(np.isnan(self.parameters), axis=1))
+
+#Worker task: fit one dataset
+def fit_calibration(data: list[FitPoint], order: int) -> tuple[NDArray[np.float64], NDArray[np.float64], Optional[FitDiagnostics]]:
+    nParams = order + 1
+    if len(data) < nParams:
+        return np.full(nParams, np.nan), np.full((nParams, nParams), np.nan), None
+    fitter = Fitter(order)
+    try:
+        fitter.run(data)
+    except Exception as error:
+        print(f"Calibration fit failed: {error}")
+        return np.full(nParams, np.nan), np.full((nParams, nParams), np.nan), None
+    return fitter.get_parameters(), fitter.get_parameter_covariance(), fitter.get_diagnostics()
+
+def fit_calibration_task(task: tuple[list[FitPoint], int]) -> tuple[NDArray[np.float64], NDArray[np.float64], Optional[FitDiagnostics]]:
+    return fit_calibration(*task)
+
+#Fit every dataset (e.g. one per run, or per focal plane detector) with a polynomial of the given order using ODR, as in Spanc
+#Datasets are split in chunks across a process pool to keep the per task overhead small; maxWorkers=1 runs in this process instead
+def fit_calibrations(datasets: list[list[FitPoint]], order: int, maxWorkers: Optional[int] = None) -> BatchCalibrationResult:
+    tasks = [(data, order) for data in datasets]
+    if maxWorkers == 1:
+        results = [fit_calibration_task(task) for task in tasks]
+    else:
+        nWorkers = maxWorkers if maxWorkers is not None else (os.cpu_count() or 1)
+        chunkSize = max(1, len(tasks) // (nWorkers * CHUNKS_PER_WORKER))
+        with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+            results = list(executor.map(fit_calibration_task, tasks, chunksize=chunkSize))
+
+    nParams = order + 1
+    parameters = np.stack([result[0] for result in results]) if len(results) != 0 else np.empty((0, nParams))
+    covariances = np.stack([result[1] for result in results]) if len(results) != 0 else np.empty((0, nParams, nParams))
+    return BatchCalibrationResult(order, parameters, covariances, [result[2] for result in results])
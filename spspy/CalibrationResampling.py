@@ -0,0 +1,136 @@
+from .Spanc import Spanc
+from .Fitter import Fitter, FitPoint, convert_fit_points_to_arrays
+import numpy as np
+from numpy.typing import NDArray
+from dataclasses import dataclass, field
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Optional
+import os
+
+DEFAULT_BOOTSTRAP_SAMPLES: int = 1000
+BATCHES_PER_WORKER: int = 2
+BAND_PERCENTILES: tuple[float, float] = (15.865, 84.135) #central 68.27%, i.e. +/- 1 sigma for a gaussian
+
+#Calibration uncertainty of one output peak from resampling the calibration peaks
+#The bootstrap band is the central 68% of the resampled values, the std are the bootstrap and jackknife standard deviations
+#Only the calibration is resampled: the output's own position error is not included (see Spanc.calculate_output_covariance)
+@dataclass
+class PeakUncertaintyBand:
+    peakID: int
+    rhoMean: float = 0.0 #cm
+    rhoBootstrapStd: float = 0.0 #cm
+    rhoLow: float = 0.0 #cm
+    rhoHigh: float = 0.0 #cm
+    rhoJackknifeStd: float = 0.0 #cm
+    excitationMean: float = 0.0 #MeV
+    excitationBootstrapStd: float = 0.0 #MeV
+    excitationLow: float = 0.0 #MeV
+    excitationHigh: float = 0.0 #MeV
+    excitationJackknifeStd: float = 0.0 #MeV
+
+@dataclass
+class ResamplingResult:
+    bootstrapParameters: NDArray[np.float64] #[sample, parameter], failed resamples are NaN
+    jackknifeParameters: NDArray[np.float64] #[left out peak, parameter]
+    bands: dict[int, PeakUncertaintyBand] = field(default_factory=dict) #keyed by output peakID
+    failedSamples: int = 0
+
+#Fit one resampled calibration; NaN if it has too few distinct positions for the order or ODR fails
+def fit_resample(x: NDArray[np.float64], y: NDArray[np.float64], xError: NDArray[np.float64], yError: NDArray[np.float64], order: int) -> NDArray[np.float64]:
+    if len(np.unique(x)) < order + 1:
+        return np.full(order + 1, np.nan)
+    fitter = Fitter(order)
+    try:
+        fitter.run([FitPoint(*point) for point in zip(x.tolist(), y.tolist(), xError.tolist(), yError.tolist())])
+    except Exception:
+        return np.full(order + 1, np.nan)
+    return fitter.get_parameters()
+
+#Worker task: a batch of bootstrap resamples. Peaks are drawn with replacement and, if jitter is set, shifted by gaussian noise
+#within their position and rho errors. The seed makes every batch independent and the whole run reproducible
+def bootstrap_batch(x: NDArray[np.float64], y: NDArray[np.float64], xError: NDArray[np.float64], yError: NDArray[np.float64], order: int,
+                    nSamples: int, seed: np.random.SeedSequence, jitter: bool) -> NDArray[np.float64]:
+    rng = np.random.default_rng(seed)
+    parameters = np.empty((nSamples, order + 1))
+    for sample in range(nSamples):
+        indices = rng.integers(0, len(x), len(x))
+        xSample = x[indices]
+        ySample = y[indices]
+        if jitter:
+            xSample = xSample + rng.normal(0.0, 1.0, len(x)) * xError[indices]
+            ySample = ySample + rng.normal(0.0, 1.0, len(x)) * yError[indices]
+        parameters[sample] = fit_resample(xSample, ySample, xError[indices], yError[indices], order)
+    return parameters
+
+#Worker task: the jackknife fits leaving out each of the given peaks in turn
+def jackknife_batch(x: NDArray[np.float64], y: NDArray[np.float64], xError: NDArray[np.float64], yError: NDArray[np.float64], order: int,
+                    leftOut: list[int]) -> NDArray[np.float64]:
+    parameters = np.empty((len(leftOut), order + 1))
+    for row, index in enumerate(leftOut):
+        keep = np.arange(len(x)) != index
+        parameters[row] = fit_resample(x[keep], y[keep], xError[keep], yError[keep], order)
+    return parameters
+
+#Jackknife standard deviation, sqrt((n-1)/n * sum (v_i - mean)^2), of each column
+def calculate_jackknife_std(values: NDArray[np.float64]) -> list[float]:
+    nSamples = values.shape[0]
+    if nSamples < 2:
+        return [0.0] * values.shape[1]
+    return np.sqrt((nSamples - 1.0) / nSamples * np.sum((values - np.mean(values, axis=0))**2.0, axis=0)).tolist()
+
+#Bootstrap and jackknife the calibration of spanc (with its current fit order) and report the rho and excitation bands of every output
+#Resamples are split into a few large batches per worker, so the pool overhead is paid per batch and not per fit. An executor can be
+#passed in to reuse its workers across calls (e.g. as the peaks are edited); otherwise a process pool is made for this call
+def resample_calibration(spanc: Spanc, nBootstrap: int = DEFAULT_BOOTSTRAP_SAMPLES, jitter: bool = True, seed: Optional[int] = None,
+                         executor: Optional[Executor] = None, maxWorkers: Optional[int] = None) -> ResamplingResult:
+    order = spanc.fitter.polynomialOrder
+    x, y, xError, yError = convert_fit_points_to_arrays(spanc.get_fit_data())
+    data = (x, y, xError, yError, order)
+
+    nWorkers = maxWorkers if maxWorkers is not None else (os.cpu_count() or 1)
+    nBatches = max(1, min(nBootstrap, nWorkers * BATCHES_PER_WORKER))
+    batchSizes = [len(batch) for batch in np.array_split(np.arange(nBootstrap), nBatches)]
+    seeds = np.random.SeedSequence(seed).spawn(nBatches)
+    leftOutBatches = [batch.tolist() for batch in np.array_split(np.arange(len(x)), min(len(x), nBatches)) if len(batch) != 0]
+
+    ownsExecutor = executor is None
+    if ownsExecutor:
+        executor = ProcessPoolExecutor(max_workers=maxWorkers)
+    try:
+        bootstrapFutures = [executor.submit(bootstrap_batch, *data, size, batchSeed, jitter) for size, batchSeed in zip(batchSizes, seeds)]
+        jackknifeFutures = [executor.submit(jackknife_batch, *data, leftOut) for leftOut in leftOutBatches]
+        bootstrapParameters = np.concatenate([future.result() for future in bootstrapFutures])
+        jackknifeParameters = np.concatenate([future.result() for future in jackknifeFutures]) if len(jackknifeFutures) != 0 else np.empty((0, order + 1))
+    finally:
+        if ownsExecutor:
+            executor.shutdown()
+
+    isValid = ~np.any(np.isnan(bootstrapParameters), axis=1)
+    result = ResamplingResult(bootstrapParameters, jackknifeParameters, failedSamples=int(np.count_nonzero(~isValid)))
+    validBootstrap = bootstrapParameters[isValid]
+    validJackknife = jackknifeParameters[~np.any(np.isnan(jackknifeParameters), axis=1)]
+
+    #evaluate every resampled calibration at every output at once, then convert to excitation per reaction in one batch
+    for rxnName, rxn in spanc.reactions.items():
+        outputs = [output for output in spanc.outputs.values() if output.rxnName == rxnName]
+        if len(outputs) == 0:
+            continue
+        positions = np.array([output.position for output in outputs])
+        powers = positions[np.newaxis, :] ** np.arange(order + 1)[:, np.newaxis] #[parameter, output]
+        rhoBootstrap = validBootstrap @ powers #[sample, output]
+        rhoJackknife = validJackknife @ powers
+        exBootstrap = rxn.calculate_excitation_batch(rhoBootstrap.ravel()).reshape(rhoBootstrap.shape)
+        exJackknife = rxn.calculate_excitation_batch(rhoJackknife.ravel()).reshape(rhoJackknife.shape)
+        rhoJackknifeStd = calculate_jackknife_std(rhoJackknife)
+        exJackknifeStd = calculate_jackknife_std(exJackknife)
+        for index, output in enumerate(outputs):
+            band = PeakUncertaintyBand(output.peakID, rhoJackknifeStd=rhoJackknifeStd[index], excitationJackknifeStd=exJackknifeStd[index])
+            if len(validBootstrap) != 0:
+                band.rhoMean = float(np.mean(rhoBootstrap[:, index]))
+                band.rhoBootstrapStd = float(np.std(rhoBootstrap[:, index], ddof=1)) if len(validBootstrap) > 1 else 0.0
+                band.rhoLow, band.rhoHigh = np.percentile(rhoBootstrap[:, index], BAND_PERCENTILES).tolist()
+                band.excitationMean = float(np.mean(exBootstrap[:, index]))
+                band.excitationBootstrapStd = float(np.std(exBootstrap[:, index], ddof=1)) if len(validBootstrap) > 1 else 0.0
+                band.excitationLow, band.excitationHigh = np.percentile(exBootstrap[:, index], BAND_PERCENTILES).tolist()
+            result.bands[output.peakID] = band
+    return result
@@ -0,0 +1,81 @@
+from .Spanc import Spanc
+import numpy as np
+from numpy.typing import NDArray
+from pathlib import Path
+from typing import Optional
+
+DEFAULT_CHUNK_SIZE: int = 1000000 #events
+ACCEPTANCE_GRID_POINTS: int = 1001 #positions at which the calibration is evaluated to find the rho range of the data
+
+#Accumulates excitation energies (MeV) into a fixed binning, chunk by chunk. Events outside the range (or NaN) are counted separately
+class ExcitationHistogram:
+    def __init__(self, bins: int, exMin: float, exMax: float):
+        self.edges = np.linspace(exMin, exMax, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.outOfRange: int = 0
+
+    def fill(self, excitations: NDArray[np.float64]) -> None:
+        isInRange = np.isfinite(excitations) & (excitations >= self.edges[0]) & (excitations <= self.edges[-1])
+        self.counts += np.histogram(excitations[isInRange], bins=self.edges)[0]
+        self.outOfRange += len(excitations) - int(np.count_nonzero(isInRange))
+
+    def get_bin_centers(self) -> NDArray[np.float64]:
+        return 0.5 * (self.edges[1:] + self.edges[:-1])
+
+#Open a file of per-event focal plane positions without reading it into memory. .npy files carry their own type and shape,
+#anything else is treated as raw binary of the given dtype
+def open_event_file(path: Path, dtype: np.dtype = np.float64) -> NDArray:
+    path = Path(path)
+    if path.suffix == ".npy":
+        return np.load(path, mmap_mode="r")
+    return np.memmap(path, dtype=dtype, mode="r")
+
+#Convert every event in inputPath from focal plane position to excitation energy (MeV), using the fitted calibration of spanc and the
+#reaction rxnName, reading and writing chunkSize events at a time so that memory use does not depend on the size of the run
+#Excitations are written to a .npy file at outputPath and/or accumulated into histogram. If uncertaintyPath is given, the per-event
+#uncertainty (calibration parameter covariance and positionError) is written there. Returns the number of events converted
+def convert_focal_plane_events(spanc: Spanc, rxnName: str, inputPath: Path, outputPath: Optional[Path] = None, histogram: Optional[ExcitationHistogram] = None,
+                               uncertaintyPath: Optional[Path] = None, positionError: float = 0.0, chunkSize: int = DEFAULT_CHUNK_SIZE, inputDtype: np.dtype = np.float64) -> int:
+    if not spanc.isFit:
+        print("Cannot convert events without a calibration fit!")
+        return 0
+    if rxnName not in spanc.reactions:
+        print("Cannot convert events for non-existant reaction ", rxnName)
+        return 0
+
+    positions = open_event_file(inputPath, inputDtype).reshape(-1)
+    nEvents = len(positions)
+    if nEvents == 0:
+        return 0
+
+    #first pass over the positions to find the rho acceptance the interpolant has to cover
+    xMin = np.inf
+    xMax = -np.inf
+    for start in range(0, nEvents, chunkSize):
+        chunk = positions[start:start+chunkSize]
+        xMin = min(xMin, float(np.nanmin(chunk)))
+        xMax = max(xMax, float(np.nanmax(chunk)))
+    rhoGrid = spanc.fitter.evaluate(np.linspace(xMin, xMax, ACCEPTANCE_GRID_POINTS))
+    interpolant = spanc.reactions[rxnName].build_excitation_interpolant(float(np.min(rhoGrid)), float(np.max(rhoGrid)))
+
+    output = np.lib.format.open_memmap(outputPath, mode="w+", dtype=np.float64, shape=(nEvents,)) if outputPath is not None else None
+    uncertainty = np.lib.format.open_memmap(uncertaintyPath, mode="w+", dtype=np.float64, shape=(nEvents,)) if uncertaintyPath is not None else None
+    covariance = spanc.fitter.get_parameter_covariance()
+    for start in range(0, nEvents, chunkSize):
+        chunk = np.asarray(positions[start:start+chunkSize], dtype=np.float64)
+        rho = spanc.fitter.evaluate(chunk)
+        excitation = interpolant(rho)
+        if output is not None:
+            output[start:start+len(chunk)] = excitation
+        if histogram is not None:
+            histogram.fill(excitation)
+        if uncertainty is not None:
+            jacobian = np.vander(chunk, len(covariance), increasing=True)
+            rhoVariance = np.einsum("ij,jk,ik->i", jacobian, covariance, jacobian) + (spanc.fitter.evaluate_derivative(chunk) * positionError)**2.0
+            uncertainty[start:start+len(chunk)] = np.abs(interpolant.derivative(rho)) * np.sqrt(rhoVariance)
+
+    if output is not None:
+        output.flush()
+    if uncertainty is not None:
+        uncertainty.flush()
+    return nEvents
@@ -0,0 +1,97 @@
+from .SPSPlot import SPSPlot, DEG2RAD
+import numpy as np
+from numpy.typing import NDArray
+from dataclasses import dataclass, field
+from scipy.optimize import minimize_scalar
+from typing import Optional
+import copy
+
+FIELD_MIN: float = 1.0 #kG
+FIELD_MAX: float = 17.0 #kG
+FIELD_GRID_POINTS: int = 200
+CONTAMINANT_WEIGHT: float = 10.0
+CENTERING_WEIGHT: float = 1.0e-3
+
+#A level of one of the reactions in SPSPlot.data
+@dataclass
+class LevelSelection:
+    rxnName: str
+    excitation: float #MeV
+
+@dataclass
+class FieldOptimizationResult:
+    magneticField: float = 0.0 #kG
+    spsAngle: float = 0.0 #deg
+    objective: float = np.inf
+    evaluations: int = 0 #objective evaluations over every angle
+    statesRho: list[float] = field(default_factory=list) #cm, at the optimum
+    contaminantsRho: list[float] = field(default_factory=list) #cm, at the optimum
+
+#Objective for a set of levels whose rho at a field of 1 kG is known; rho at any other field B is then rho1/B
+#States are penalized by the square of their distance (cm) outside the window [rhoMin + margin, rhoMax - margin], contaminants by the square
+#of their depth inside the exclusion region, and a small term keeps the states centered in the window so the optimum is unique
+class FieldObjective:
+    def __init__(self, statesRho1: NDArray[np.float64], contaminantsRho1: NDArray[np.float64], window: tuple[float, float], exclusion: tuple[float, float]):
+        self.statesRho1 = statesRho1
+        self.contaminantsRho1 = contaminantsRho1
+        self.window = window
+        self.exclusion = exclusion
+        self.evaluations: int = 0
+
+    def __call__(self, magneticField: float) -> float:
+        self.evaluations += 1
+        statesRho = self.statesRho1 / magneticField
+        contaminantsRho = self.contaminantsRho1 / magneticField
+        outside = np.maximum(self.window[0] - statesRho, 0.0) + np.maximum(statesRho - self.window[1], 0.0)
+        inside = np.maximum(np.minimum(contaminantsRho - self.exclusion[0], self.exclusion[1] - contaminantsRho), 0.0)
+        value = np.sum(outside**2.0) + CONTAMINANT_WEIGHT * np.sum(inside**2.0)
+        if len(statesRho) != 0:
+            value += CENTERING_WEIGHT * (np.mean(statesRho) - 0.5 * (self.window[0] + self.window[1]))**2.0
+        return float(value)
+
+#rho (cm) at 1 kG of each level, with the beam energy of sps and the given angle (deg). Reactions are copied, sps is not modified
+def calculate_levels_rho1(sps: SPSPlot, levels: list[LevelSelection], angle: float) -> NDArray[np.float64]:
+    rho = np.zeros(len(levels))
+    for rxnName in set(level.rxnName for level in levels):
+        rxn = copy.deepcopy(sps.data[rxnName].rxn)
+        rxn.update_parameters(sps.beamEnergy, angle * DEG2RAD, 1.0)
+        indices = [index for index, level in enumerate(levels) if level.rxnName == rxnName]
+        rho[indices] = rxn.convert_ejectile_KE_2_rho_batch(rxn.calculate_ejectile_KE_batch(np.array([levels[index].excitation for index in indices])))
+    return rho
+
+#Search for the magnetic field (kG), and optionally the SPS angle (deg) from a list of candidates, which puts the states inside the rho window
+#of sps ([rhoMin, rhoMax] shrunk by margin, cm) and keeps the contaminants out of the exclusion region (default: the whole rho window)
+#For each angle the levels' kinematics are computed once in a batch, after which the objective is pure arithmetic: a grid over the field range
+#is refined with a bounded scalar minimization. The total number of objective evaluations is reported in the result
+def optimize_magnetic_field(sps: SPSPlot, states: list[LevelSelection], contaminants: Optional[list[LevelSelection]] = None, margin: float = 0.0,
+                            exclusion: Optional[tuple[float, float]] = None, fieldRange: tuple[float, float] = (FIELD_MIN, FIELD_MAX), angles: Optional[list[float]] = None) -> FieldOptimizationResult:
+    if contaminants is None:
+        contaminants = []
+    window = (sps.rhoMin + margin, sps.rhoMax - margin)
+    if exclusion is None:
+        exclusion = (sps.rhoMin, sps.rhoMax)
+    if angles is None:
+        angles = [sps.spsAngle]
+
+    result = FieldOptimizationResult()
+    fieldGrid = np.linspace(fieldRange[0], fieldRange[1], FIELD_GRID_POINTS)
+    fieldStep = fieldGrid[1] - fieldGrid[0]
+    for angle in angles:
+        statesRho1 = calculate_levels_rho1(sps, states, angle)
+        contaminantsRho1 = calculate_levels_rho1(sps, contaminants, angle)
+        objective = FieldObjective(statesRho1, contaminantsRho1, window, exclusion)
+
+        gridValues = [objective(b) for b in fieldGrid]
+        bestIndex = int(np.argmin(gridValues))
+        bounds = (max(fieldGrid[bestIndex] - fieldStep, fieldRange[0]), min(fieldGrid[bestIndex] + fieldStep, fieldRange[1]))
+        refined = minimize_scalar(objective, bounds=bounds, method="bounded")
+        bestField, bestValue = (refined.x, refined.fun) if refined.fun <= gridValues[bestIndex] else (fieldGrid[bestIndex], gridValues[bestIndex])
+
+        result.evaluations += objective.evaluations
+        if bestValue < result.objective:
+            result.magneticField = float(bestField)
+            result.spsAngle = angle
+            result.objective = float(bestValue)
+            result.statesRho = (statesRho1 / bestField).tolist()
+            result.contaminantsRho = (contaminantsRho1 / bestField).tolist()
+    return result
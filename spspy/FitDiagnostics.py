@@ -0,0 +1,47 @@
+import numpy as np
+from numpy.typing import NDArray
+from numpy.polynomial import polynomial as poly
+from dataclasses import dataclass
+
+#Goodness of fit and per-point influence of a polynomial fit y = sum_k beta_k x^k to data with errors in both x and y
+#Points are weighted by the effective variance yError^2 + (xError * dy/dx)^2, as in ODR. Residuals are y - f(x) (unweighted), while the
+#studentized residuals, leverages, and Cook's distances are those of the equivalent weighted linear least squares problem
+@dataclass
+class FitDiagnostics:
+    chisquare: float
+    ndf: int
+    reducedChisquare: float
+    residuals: NDArray[np.float64]
+    effectiveErrors: NDArray[np.float64]
+    studentizedResiduals: NDArray[np.float64]
+    leverages: NDArray[np.float64]
+    cooksDistances: NDArray[np.float64]
+
+#Effective y error of each point for the polynomial with parameters beta
+def calculate_effective_errors(beta: NDArray[np.float64], x: NDArray[np.float64], xError: NDArray[np.float64], yError: NDArray[np.float64]) -> NDArray[np.float64]:
+    derivative = poly.polyval(x, poly.polyder(beta)) if len(beta) > 1 else np.zeros(len(x))
+    return np.sqrt(yError**2.0 + (xError * derivative)**2.0)
+
+#Diagonal of the weighted hat matrix H = W^1/2 V (V^T W V)^-1 V^T W^1/2 for the Vandermonde matrix V of the given order,
+#i.e. the squared row norms of Q from the QR decomposition of W^1/2 V. Points with zero weight have zero leverage
+def calculate_leverages(x: NDArray[np.float64], weights: NDArray[np.float64], order: int) -> NDArray[np.float64]:
+    design = poly.polyvander(x, order) * np.sqrt(weights)[:, np.newaxis]
+    q, _ = np.linalg.qr(design, mode="reduced")
+    return np.sum(q**2.0, axis=1)
+
+#All of the diagnostics in one vectorized pass over the arrays from convert_fit_points_to_arrays
+def calculate_fit_diagnostics(beta: NDArray[np.float64], x: NDArray[np.float64], y: NDArray[np.float64], xError: NDArray[np.float64], yError: NDArray[np.float64]) -> FitDiagnostics:
+    nParams = len(beta)
+    residuals = y - poly.polyval(x, beta)
+    effectiveErrors = calculate_effective_errors(beta, x, xError, yError)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = np.where(effectiveErrors > 0.0, 1.0 / effectiveErrors**2.0, 0.0)
+        weightedResiduals = residuals * np.sqrt(weights)
+        chisquare = float(np.sum(weightedResiduals**2.0))
+        ndf = len(x) - nParams
+        reducedChisquare = chisquare / ndf if ndf > 0 else np.inf
+
+        leverages = calculate_leverages(x, weights, nParams - 1)
+        studentizedResiduals = weightedResiduals / np.sqrt(reducedChisquare * (1.0 - leverages))
+        cooksDistances = studentizedResiduals**2.0 * leverages / (nParams * (1.0 - leverages))
+    return FitDiagnostics(chisquare, ndf, reducedChisquare, residuals, effectiveErrors, studentizedResiduals, leverages, cooksDistances)
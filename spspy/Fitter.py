@@ -2,11 +2,14 @@ import numpy as np
 from numpy.typing import NDArray
 from numpy.polynomial import Polynomial
 from scipy import odr
+from .FitDiagnostics import FitDiagnostics, calculate_fit_diagnostics
 from dataclasses import dataclass
 from typing import Optional
 
 INVALID_FIT_RESULT = np.inf
 INVALID_NDF = -1
+FAST_PATH_RATIO_MAX: float = 0.1 #largest xError * dy/dx relative to yError for which the fast path replaces ODR
+EFFECTIVE_VARIANCE_PASSES: int = 3
 
 @dataclass
 class FitPoint:
@@ -43,29 +46,166 @@ def convert_resid_points_to_arrays(data: list[FitResidual]) -> tuple[NDArray[np.
         studentResidArray[index] = point.studentizedResidual
     return xArray, residArray, studentResidArray
 
+#Number of iterations ODRPACK took for a fit with nParams parameters of a single response and input variable
+#ODR does not expose it by name: it sits in iwork at the NITERI offset of ODRPACK's DIWINF, i.e. after the message arrays (nq*np + 1 and
+#nq*m + 1 entries), the np entry IFIX2 array, and 13 scalar settings (stop, nnzw, npp, idf, job, iprint, luns, nrow, ntol, neta, maxit)
+def get_odr_iterations(output: odr.Output, nParams: int, nResponses: int = 1, nInputs: int = 1) -> int:
+    return int(output.iwork[nResponses * nParams + nResponses * nInputs + nParams + 14])
+
+#Closed form weighted linear least squares polynomial through the data, weighting only by the y errors
+def calculate_wls_parameters(x: NDArray[np.float64], y: NDArray[np.float64], yError: NDArray[np.float64], order: int) -> NDArray[np.float64]:
+    weights = np.where(yError > 0.0, 1.0 / np.where(yError > 0.0, yError, 1.0), 1.0)
+    design = np.polynomial.polynomial.polyvander(x, order) * weights[:, np.newaxis]
+    return np.linalg.lstsq(design, y * weights, rcond=None)[0]
+
+#Result of fit_effective_variance, with the attributes of odr.Output used by spspy
+#As for ODR, cov_beta is not scaled by the residual variance: sd_beta = sqrt(diag(cov_beta) * res_var)
+class LeastSquaresOutput:
+    def __init__(self, beta: NDArray[np.float64], cov_beta: NDArray[np.float64], res_var: float, delta: NDArray[np.float64], eps: NDArray[np.float64], passes: int):
+        self.beta = beta
+        self.cov_beta = cov_beta
+        self.res_var = res_var
+        self.sd_beta = np.sqrt(np.diagonal(cov_beta) * res_var)
+        self.delta = delta
+        self.eps = eps
+        self.passes = passes
+        self.info = 1
+        self.stopreason = ["Effective variance weighted least squares"]
+
+#Weighted linear least squares polynomial fit (by QR decomposition) with errors in both x and y, using the effective variance
+#yError^2 + (xError * dy/dx)^2: the first pass weights by the y errors alone, each following one by the slope of the previous solution
+#delta and eps are the x and y corrections of the points to first order, as ODR would report them
+def fit_effective_variance(x: NDArray[np.float64], y: NDArray[np.float64], xError: NDArray[np.float64], yError: NDArray[np.float64], order: int,
+                           passes: int = EFFECTIVE_VARIANCE_PASSES) -> LeastSquaresOutput:
+    vandermonde = np.polynomial.polynomial.polyvander(x, order)
+    variance = yError**2.0
+    for _ in range(passes):
+        sqrtWeights = 1.0 / np.sqrt(variance)
+        q, r = np.linalg.qr(vandermonde * sqrtWeights[:, np.newaxis], mode="reduced")
+        beta = np.linalg.solve(r, q.T @ (y * sqrtWeights))
+        slope = np.polynomial.polynomial.polyval(x, np.polynomial.polynomial.polyder(beta)) if order > 0 else np.zeros(len(x))
+        variance = yError**2.0 + (xError * slope)**2.0
+
+    rInverse = np.linalg.inv(r)
+    residuals = y - vandermonde @ beta
+    ndf = len(x) - (order + 1)
+    resVar = float(np.sum(residuals**2.0 / variance) / ndf) if ndf > 0 else 0.0
+    delta = xError**2.0 * slope * residuals / variance
+    return LeastSquaresOutput(beta, rInverse @ rInverse.T, resVar, delta, residuals - slope * delta, passes)
+
+#The fast path is used when the x errors, propagated through the slope, are small next to the y errors (and ODR is then not needed)
+def is_fast_path_valid(beta: NDArray[np.float64], x: NDArray[np.float64], xError: NDArray[np.float64], yError: NDArray[np.float64]) -> bool:
+    if np.any(yError <= 0.0) or len(x) <= len(beta):
+        return False
+    slope = np.polynomial.polynomial.polyval(x, np.polynomial.polynomial.polyder(beta)) if len(beta) > 1 else np.zeros(len(x))
+    return bool(np.all(np.abs(xError * slope) <= FAST_PATH_RATIO_MAX * yError))
+
+#Polynomial fit with errors in x and y, by ODR or, when the x errors hardly matter, the effective variance fast path (useFastPath)
 class Fitter:
-    def __init__(self, order: int =1):
+    def __init__(self, order: int =1, useFastPath: bool = True):
         self.polynomialOrder: int = order
-        self.fitResults: Optional[odr.Output] = None
+        self.useFastPath: bool = useFastPath
+        self.fitResults: Optional[odr.Output | LeastSquaresOutput] = None
         self.fitData: Optional[list[FitPoint]] = None
         self.function: Optional[Polynomial] = None
 
+        self.iterations: int = 0 #of the last fit
+        self.coldIterations: Optional[int] = None #of a fit of the current data from ODR's default starting point, for comparison with warm starts
+        self.isWarmStart: bool = False #the last fit was a warm start
+        self.isFastPath: bool = False #the last fit used the effective variance fast path instead of ODR
+
+    #fitters saved before iteration counting and the fast path were added lack their attributes
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+        self.__dict__.update(state)
+
     def set_polynomial_order(self, order: int) -> None:
         self.polynomialOrder = order
 
+    #Fast path fit of the arrays if it is enabled and valid for them, otherwise None
+    def run_fast_path(self, xArray: NDArray[np.float64], yArray: NDArray[np.float64], xErrorArray: NDArray[np.float64], yErrorArray: NDArray[np.float64]) -> Optional[LeastSquaresOutput]:
+        if not self.useFastPath or np.any(yErrorArray <= 0.0) or len(xArray) <= self.polynomialOrder + 1:
+            return None
+        output = fit_effective_variance(xArray, yArray, xErrorArray, yErrorArray, self.polynomialOrder)
+        if not is_fast_path_valid(output.beta, xArray, xErrorArray, yErrorArray):
+            return None
+        return output
+
+    def set_fast_path_results(self, output: LeastSquaresOutput) -> None:
+        self.fitResults = output
+        self.function = Polynomial(self.fitResults.beta)
+        self.iterations = output.passes
+        self.isFastPath = True
+
     def run(self, data: list[FitPoint] = None) -> None:
         if data is not None:
             self.fitData = data
         
         if self.fitData is not None:
             xArray, yArray, xErrorArray, yErrorArray = convert_fit_points_to_arrays(self.fitData)
+            self.isWarmStart = False
+            fastOutput = self.run_fast_path(xArray, yArray, xErrorArray, yErrorArray)
+            if fastOutput is not None:
+                self.set_fast_path_results(fastOutput)
+                return
             modelData = odr.RealData(xArray, y=yArray, sx=xErrorArray, sy=yErrorArray)
             model = odr.polynomial(self.polynomialOrder)
             self.fitResults = odr.ODR(modelData, model).run()
             self.function = Polynomial(self.fitResults.beta)
+            self.iterations = get_odr_iterations(self.fitResults, self.polynomialOrder + 1)
+            self.coldIterations = self.iterations
+            self.isFastPath = False
         else:
             print("Cannot run fitter without setting data to be fit!")
 
+    #Incremental version of run, for when the data changed a little (a point added, edited, or removed) since the last fit
+    #ODR starts from the previous parameters and from the previous x corrections (delta) of the points whose x is unchanged.
+    #Without a previous fit of the same order, it starts from the weighted least squares solution instead of ODR's default
+    def refit(self, data: list[FitPoint] = None) -> None:
+        previousResults = self.fitResults if self.fitResults is not None and len(self.fitResults.beta) == self.polynomialOrder + 1 else None
+        previousData = self.fitData
+        if data is not None:
+            self.fitData = data
+        if self.fitData is None:
+            print("Cannot run fitter without setting data to be fit!")
+            return
+
+        xArray, yArray, xErrorArray, yErrorArray = convert_fit_points_to_arrays(self.fitData)
+        self.isWarmStart = True
+        self.coldIterations = None
+        fastOutput = self.run_fast_path(xArray, yArray, xErrorArray, yErrorArray)
+        if fastOutput is not None:
+            self.set_fast_path_results(fastOutput)
+            return
+        delta0 = None
+        if previousResults is not None:
+            beta0 = previousResults.beta
+            previousDeltas = dict(zip([point.x for point in previousData], np.atleast_1d(previousResults.delta).tolist()))
+            delta0 = np.array([previousDeltas.get(x, 0.0) for x in xArray.tolist()])
+        else:
+            beta0 = calculate_wls_parameters(xArray, yArray, yErrorArray, self.polynomialOrder)
+        modelData = odr.RealData(xArray, y=yArray, sx=xErrorArray, sy=yErrorArray)
+        model = odr.polynomial(self.polynomialOrder)
+        fit = odr.ODR(modelData, model, beta0=beta0, delta0=delta0)
+        if delta0 is not None:
+            fit.set_job(del_init=1)
+        self.fitResults = fit.run()
+        self.function = Polynomial(self.fitResults.beta)
+        self.iterations = get_odr_iterations(self.fitResults, self.polynomialOrder + 1)
+        self.isFastPath = False
+
+    #Iterations saved by the last fit if it was a warm ODR start (0 otherwise), relative to a cold ODR fit of the same data
+    #The cold fit is only run (once per refit) when this is requested, so it costs nothing when the savings are not looked at
+    def get_iterations_saved(self) -> int:
+        if not self.isWarmStart or self.isFastPath or self.fitData is None:
+            return 0
+        if self.coldIterations is None:
+            xArray, yArray, xErrorArray, yErrorArray = convert_fit_points_to_arrays(self.fitData)
+            modelData = odr.RealData(xArray, y=yArray, sx=xErrorArray, sy=yErrorArray)
+            coldResults = odr.ODR(modelData, odr.polynomial(self.polynomialOrder)).run()
+            self.coldIterations = get_odr_iterations(coldResults, self.polynomialOrder + 1)
+        return self.coldIterations - self.iterations
+
     def get_parameters(self) -> NDArray[np.float64] :
         if self.fitResults is not None:
             return self.fitResults.beta
@@ -76,9 +216,15 @@ class Fitter:
             return self.fitResults.sd_beta
         return np.array({INVALID_FIT_RESULT})
 
+    #Covariance of the parameters, scaled by the residual variance so that its diagonal matches get_parameter_errors
+    def get_parameter_covariance(self) -> NDArray[np.float64] :
+        if self.fitResults is not None:
+            return self.fitResults.cov_beta * self.fitResults.res_var
+        return np.array({INVALID_FIT_RESULT})
+
     def get_ndf(self) -> int:
         if self.fitResults is not None:
-            return len(self.fitData) - 1
+            return len(self.fitData) - (self.polynomialOrder + 1)
         return INVALID_NDF
 
     def evaluate(self, x: float) -> float:
@@ -96,43 +242,28 @@ class Fitter:
             return x**index
         return INVALID_FIT_RESULT
 
+    def get_diagnostics(self) -> Optional[FitDiagnostics]:
+        if self.fitResults is not None:
+            return calculate_fit_diagnostics(self.fitResults.beta, *convert_fit_points_to_arrays(self.fitData))
+        return None
+
     def get_chisquare(self) -> float:
-        if self.function is not None:
-            yEffErrorArray = [np.sqrt(point.yError**2.0 + (point.xError * self.evaluate_derivative(point.x))**2.0) for point in self.fitData]
-            chisq = 0.0
-            for index, point in enumerate(self.fitData):
-                chisq = ((point.y - self.evaluate(point.x)) / yEffErrorArray[index])**2.0
-            return chisq
+        diagnostics = self.get_diagnostics()
+        if diagnostics is not None:
+            return diagnostics.chisquare
         return INVALID_FIT_RESULT
 
+    #without degrees of freedom (including an invalid fit) there is no reduced chi-square
     def get_reduced_chisquare(self) -> float:
         ndf = self.get_ndf()
         chisq = self.get_chisquare()
-        if chisq == INVALID_FIT_RESULT or ndf == INVALID_NDF:
+        if chisq == INVALID_FIT_RESULT or ndf <= 0:
             return INVALID_FIT_RESULT
         else:
             return chisq/ndf
 
     def get_residuals(self) -> list[FitResidual]:
-        if self.fitData is not None:
-            fitResiduals = [FitResidual(point.x, point.y - self.evaluate(point.x), 0.0) for point in self.fitData]
-
-            #compute the leverage and studentize
-            xMean = 0.0
-            rmse = 0.0
-            npoints = len(fitResiduals)
-            for resid in fitResiduals:
-                xMean += resid.x
-                rmse += resid.residual**2.0
-            xMean /= npoints
-            rmse /= self.get_ndf()
-
-            meanDiffSq = 0.0
-            for resid in fitResiduals:
-                meanDiffSq += (resid.x - xMean) ** 2.0
-            meanDiffSq /= npoints
-            for resid in fitResiduals:
-                leverage = 1.0/npoints + (resid.x - xMean)/meanDiffSq
-                resid.studentizedResidual = resid.residual / (rmse * np.sqrt(1.0 - leverage))
-            return fitResiduals
+        diagnostics = self.get_diagnostics()
+        if diagnostics is not None:
+            return [FitResidual(point.x, residual, studentized) for point, residual, studentized in zip(self.fitData, diagnostics.residuals.tolist(), diagnostics.studentizedResiduals.tolist())]
         return []
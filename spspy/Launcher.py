@@ -4,9 +4,6 @@ from PySide6.QtWidgets import QHBoxLayout, QVBoxLayout, QGroupBox
 from PySide6.QtWidgets import QPushButton
 from PySide6.QtGui import QAction
 
-from .SPSPlotUI import run_spsplot_ui, SPSPlotGUI
-from .SpancUI import run_spanc_ui, SpancGUI
-
 import sys
 import matplotlib as mpl
 from qdarktheme import load_stylesheet
@@ -30,10 +27,13 @@ class Launcher(QMainWindow):
         self.mainLayout.addWidget(self.spancButton)
         self.show()
 
+    #The tools are only imported once launched, so the launcher starts without loading both of them
     def handle_spsplot(self) -> None:
+        from .SPSPlotUI import SPSPlotGUI
         SPSPlotGUI(self)
 
     def handle_spanc(self) -> None:
+        from .SpancUI import SpancGUI
         #run_spanc_ui()
         SpancGUI(self)
 
@@ -0,0 +1,94 @@
+from .Fitter import Fitter, FitPoint
+import numpy as np
+from numpy.typing import NDArray
+from dataclasses import dataclass, field
+from concurrent.futures import Executor
+from enum import Enum
+from typing import Optional
+import os
+
+PARALLEL_FIT_POINTS_MIN: int = 5000 #orders x points; below this the fits take less than ~0.1 s, which a process pool cannot beat
+
+class SelectionCriterion(Enum):
+    AIC = "AIC"
+    BIC = "BIC"
+    LOOCV = "LOOCV"
+
+#Scores of one polynomial order fit to a calibration. Lower is better for aic, bic, and looChisquare
+#With gaussian errors -2 ln(L) is the chi-square up to a constant, so aic = chisq + 2k and bic = chisq + k ln(n) for k parameters
+#looChisquare is the leave-one-out chi-square from the PRESS identity, e_(i) = e_i / (1 - h_i): exact for a weighted linear fit,
+#and a close approximation for the ODR fit as long as the effective weights change little when a point is dropped
+@dataclass
+class OrderScore:
+    order: int
+    parameters: NDArray[np.float64]
+    chisquare: float
+    ndf: int
+    reducedChisquare: float
+    aic: float
+    bic: float
+    looChisquare: float
+
+    def get_score(self, criterion: SelectionCriterion) -> float:
+        if criterion == SelectionCriterion.AIC:
+            return self.aic
+        elif criterion == SelectionCriterion.BIC:
+            return self.bic
+        return self.looChisquare
+
+@dataclass
+class OrderSelectionResult:
+    criterion: SelectionCriterion
+    recommendedOrder: int
+    scores: list[OrderScore] = field(default_factory=list)
+
+#Worker task: fit and score a single order. An order whose fit fails scores inf on every criterion
+def score_fit_order(data: list[FitPoint], order: int) -> OrderScore:
+    fitter = Fitter(order)
+    try:
+        fitter.run(data)
+        diagnostics = fitter.get_diagnostics()
+    except Exception as error:
+        print(f"Fit of order {order} failed: {error}")
+        diagnostics = None
+    if diagnostics is None:
+        return OrderScore(order, np.full(order + 1, np.nan), np.inf, len(data) - (order + 1), np.inf, np.inf, np.inf, np.inf)
+    nPoints = len(data)
+    nParams = order + 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        looChisquare = float(np.sum((diagnostics.residuals / diagnostics.effectiveErrors / (1.0 - diagnostics.leverages))**2.0))
+    if not np.isfinite(looChisquare):
+        looChisquare = np.inf
+    return OrderScore(order, fitter.get_parameters(), diagnostics.chisquare, diagnostics.ndf, diagnostics.reducedChisquare,
+                      diagnostics.chisquare + 2.0 * nParams, diagnostics.chisquare + nParams * np.log(nPoints), looChisquare)
+
+#Orders with at least one degree of freedom for nPoints points, up to maxOrder
+def get_candidate_orders(nPoints: int, maxOrder: int) -> list[int]:
+    return [order for order in range(maxOrder + 1) if nPoints > order + 1]
+
+#A typical calibration (tens of points, a handful of orders) fits in milliseconds, much less than it takes to hand the work to another
+#process, so only large selections (or many of them, e.g. bootstrapped) are worth a process pool
+def is_serial_selection(nPoints: int, nOrders: int, maxWorkers: Optional[int] = None) -> bool:
+    nWorkers = maxWorkers if maxWorkers is not None else (os.cpu_count() or 1)
+    return nWorkers == 1 or nOrders < 2 or nPoints * nOrders < PARALLEL_FIT_POINTS_MIN
+
+#Fit every polynomial order from 0 to maxOrder and recommend the one with the lowest score for the criterion
+#Only orders with at least one degree of freedom are fit. Small selections are fit in this process (see is_serial_selection). Large ones
+#are fit in a process pool, as ODR calls back into Python for the model and holds the GIL. An executor can be passed in to reuse its
+#workers across calls (see Spanc.get_executor); otherwise a pool is made for this call. maxWorkers=1 always fits in this process.
+#A recommendedOrder of -1 means there were too few points to fit any order
+def select_fit_order(data: list[FitPoint], maxOrder: int, criterion: SelectionCriterion = SelectionCriterion.BIC,
+                     executor: Optional[Executor] = None, maxWorkers: Optional[int] = None) -> OrderSelectionResult:
+    orders = get_candidate_orders(len(data), maxOrder)
+    if len(orders) == 0:
+        return OrderSelectionResult(criterion, -1)
+    if is_serial_selection(len(data), len(orders), maxWorkers):
+        scores = [score_fit_order(data, order) for order in orders]
+    elif executor is not None:
+        scores = list(executor.map(score_fit_order, [data] * len(orders), orders))
+    else:
+        from concurrent.futures import ProcessPoolExecutor #pulls in multiprocessing, which Spanc does not otherwise need at import
+        with ProcessPoolExecutor(max_workers=maxWorkers) as ownExecutor:
+            scores = list(ownExecutor.map(score_fit_order, [data] * len(orders), orders))
+    best = min(scores, key=lambda score: score.get_score(criterion))
+    return OrderSelectionResult(criterion, best.order, scores)
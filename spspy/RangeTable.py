@@ -0,0 +1,108 @@
+import pycatima as catima
+import numpy as np
+from numpy.typing import NDArray
+from bisect import bisect_right
+from math import log, exp
+
+RANGE_TABLE_ENERGY_MIN: float = 1.0e-4 #MeV/u
+RANGE_TABLE_ENERGY_MAX: float = 1.0e3 #MeV/u
+RANGE_TABLE_POINTS: int = 1500
+RANGE_TABLE_NEWTON_STEPS: int = 1
+
+#Evaluating a scipy PPoly costs several numpy calls, which dominates when looking up one energy at a time
+#this evaluates the same piecewise polynomial for a single float using plain Python
+class ScalarPPoly:
+    def __init__(self, function: "scipy.interpolate.PPoly"):
+        self.breaks: list[float] = function.x.tolist()
+        self.coeffs: list[list[float]] = function.c.T.tolist()
+        self.lastInterval = len(self.breaks) - 2
+
+    def __call__(self, x: float) -> float:
+        interval = min(max(bisect_right(self.breaks, x) - 1, 0), self.lastInterval)
+        dx = x - self.breaks[interval]
+        value = 0.0
+        for c in self.coeffs[interval]:
+            value = value * dx + c
+        return value
+
+#Range-energy table for one projectile in one material, built on a log-energy grid
+#The range R(E) (g/cm^2) is the integral of dx/dE = A/(dE/dx), here in terms of u = ln(E) where dR/du = A*E/(dE/dx)
+#Energy loss through a thickness t is then E_out = R^-1(R(E_in) - t), and reverse energy loss is E_in = R^-1(R(E_out) + t)
+#The inversion is a monotone (PCHIP) lookup, polished with a few Newton steps on R(u) so that R and its inverse are consistent;
+#without this thin layers would lose accuracy, as the loss is the difference of two nearly equal ranges
+class RangeTable:
+    def __init__(self, energy: NDArray[np.float64], dedx: NDArray[np.float64], A: float):
+        self.energy = energy #MeV/u
+        self.dedx = dedx #MeV/(g/cm^2)
+        self.A = A #u
+
+        #scipy.interpolate is slow to import, and only needed once tables are built
+        from scipy.interpolate import CubicSpline, PchipInterpolator
+        self.logEnergy = np.log(self.energy)
+        self.rangeFunction = CubicSpline(self.logEnergy, self.A * self.energy / self.dedx).antiderivative()
+        self.rangeDerivative = self.rangeFunction.derivative()
+        self.range = self.rangeFunction(self.logEnergy)
+        self.inverseFunction = PchipInterpolator(self.range, self.logEnergy)
+
+        self.rangeScalar = ScalarPPoly(self.rangeFunction)
+        self.rangeDerivativeScalar = ScalarPPoly(self.rangeDerivative)
+        self.inverseScalar = ScalarPPoly(self.inverseFunction)
+        self.logEnergyMin = float(self.logEnergy[0])
+        self.logEnergyMax = float(self.logEnergy[-1])
+        self.rangeMax = float(self.range[-1])
+
+    #range (g/cm^2) of particles of the given energies (MeV/u)
+    def get_range(self, energies: NDArray[np.float64]) -> NDArray[np.float64]:
+        logEnergy = np.clip(np.log(np.maximum(energies, RANGE_TABLE_ENERGY_MIN)), self.logEnergy[0], self.logEnergy[-1])
+        return self.rangeFunction(logEnergy)
+
+    #energy (MeV/u) of particles with the given ranges (g/cm^2). Particles with no range left have zero energy
+    def get_energy(self, ranges: NDArray[np.float64]) -> NDArray[np.float64]:
+        ranges = np.asarray(ranges, dtype=np.float64)
+        energies = np.zeros(ranges.shape)
+        valid = ranges > 0.0
+        target = np.minimum(ranges[valid], self.range[-1])
+        logEnergy = self.inverseFunction(target)
+        for _ in range(RANGE_TABLE_NEWTON_STEPS):
+            logEnergy = np.clip(logEnergy - (self.rangeFunction(logEnergy) - target) / self.rangeDerivative(logEnergy), self.logEnergy[0], self.logEnergy[-1])
+        energies[valid] = np.exp(logEnergy)
+        return energies
+
+    #Scalar versions of get_range and get_energy
+    def get_range_value(self, energy: float) -> float:
+        return self.rangeScalar(min(max(log(max(energy, RANGE_TABLE_ENERGY_MIN)), self.logEnergyMin), self.logEnergyMax))
+
+    def get_energy_value(self, rangeValue: float) -> float:
+        if rangeValue <= 0.0:
+            return 0.0
+        target = min(rangeValue, self.rangeMax)
+        logEnergy = self.inverseScalar(target)
+        for _ in range(RANGE_TABLE_NEWTON_STEPS):
+            logEnergy = min(max(logEnergy - (self.rangeScalar(logEnergy) - target) / self.rangeDerivativeScalar(logEnergy), self.logEnergyMin), self.logEnergyMax)
+        return exp(logEnergy)
+
+    #energy loss (MeV/u) for particles of the given initial energies (MeV/u) traversing the given path lengths (g/cm^2)
+    def get_energyloss(self, energies: NDArray[np.float64], pathLengths: NDArray[np.float64]) -> NDArray[np.float64]:
+        if np.ndim(energies) == 0 and np.ndim(pathLengths) == 0:
+            if pathLengths <= 0.0:
+                return 0.0
+            return energies - self.get_energy_value(self.get_range_value(energies) - pathLengths)
+        energies, pathLengths = np.broadcast_arrays(np.asarray(energies, dtype=np.float64), np.asarray(pathLengths, dtype=np.float64))
+        return np.where(pathLengths > 0.0, energies - self.get_energy(self.get_range(energies) - pathLengths), 0.0)
+
+    #energy gain (MeV/u) for particles of the given final energies (MeV/u) which traversed the given path lengths (g/cm^2)
+    def get_reverse_energyloss(self, energies: NDArray[np.float64], pathLengths: NDArray[np.float64]) -> NDArray[np.float64]:
+        if np.ndim(energies) == 0 and np.ndim(pathLengths) == 0:
+            if pathLengths <= 0.0:
+                return 0.0
+            return self.get_energy_value(self.get_range_value(energies) + pathLengths) - energies
+        energies, pathLengths = np.broadcast_arrays(np.asarray(energies, dtype=np.float64), np.asarray(pathLengths, dtype=np.float64))
+        return np.where(pathLengths > 0.0, self.get_energy(self.get_range(energies) + pathLengths) - energies, 0.0)
+
+def build_range_table(projectile: catima.Projectile, material: catima.Material) -> RangeTable:
+    energy = np.geomspace(RANGE_TABLE_ENERGY_MIN, RANGE_TABLE_ENERGY_MAX, RANGE_TABLE_POINTS)
+    dedx = np.empty(len(energy))
+    for index, e in enumerate(energy):
+        projectile.T(e)
+        dedx[index] = catima.dedx(projectile, material)
+    return RangeTable(energy, dedx, projectile.A())
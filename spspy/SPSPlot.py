@@ -1,7 +1,8 @@
-from .SPSReaction import *
-from .SPSTarget import *
-from .data.NuclearData import *
+from .SPSReaction import Reaction, RxnParameters
+from .SPSTarget import SPSTarget, TargetLayer
+from .data.NuclearData import get_excitations, prefetch_excitations
 from dataclasses import dataclass, field
+import numpy as np
 import csv
 
 DEG2RAD: float = np.pi / 180.0
@@ -37,22 +38,36 @@ class SPSPlot:
             target = SPSTarget([TargetLayer([(1,1,1)], 0.0)]) #insert a dummy target if an invalid one is passed (i.e. no energy loss)
 
         plotData = PlotData(Reaction(params, target))
-        exList = get_excitations(plotData.rxn.residual.Z, plotData.rxn.residual.A)
-        for ex in exList:
-            ke = plotData.rxn.calculate_ejectile_KE(ex)
-            r = plotData.rxn.convert_ejectile_KE_2_rho(ke)
-            z = plotData.rxn.calculate_focal_plane_offset(ke)
-            plotData.excitations.append(Excitation(ex, ke, r, z))
+        exArray = np.array(get_excitations(plotData.rxn.residual.Z, plotData.rxn.residual.A))
+        keArray = plotData.rxn.calculate_ejectile_KE_batch(exArray)
+        rhoArray = plotData.rxn.convert_ejectile_KE_2_rho_batch(keArray)
+        zArray = plotData.rxn.calculate_focal_plane_offset_batch(keArray)
+        plotData.excitations = [Excitation(ex, ke, r, z) for ex, ke, r, z in zip(exArray.tolist(), keArray.tolist(), rhoArray.tolist(), zArray.tolist())]
         self.data[str(plotData.rxn)] = plotData
         
+    #Add many reactions, each given as (params, targetName), fetching the levels of all of the residuals at once
+    def add_reactions(self, reactions: list[tuple[RxnParameters, str]]) -> None:
+        nuclei = []
+        for params, _ in reactions:
+            residualZ = params.target.Z + params.projectile.Z - params.ejectile.Z
+            residualA = params.target.A + params.projectile.A - params.ejectile.A
+            nuclei.append((residualZ, residualA))
+        prefetch_excitations(nuclei)
+        for params, targetName in reactions:
+            self.add_reaction(params, targetName)
+
     def update_reactions(self) -> None:
         for datum in self.data.values():
             datum.rxn.update_parameters(self.beamEnergy, self.spsAngle * DEG2RAD, self.magneticField)
             if datum.rxn.targetMaterial.name in self.targets:
-                datum.rxn.targetMaterial = self.targets[datum.rxn.targetMaterial.name]
-            for ex in datum.excitations:
-                ex.kineticEnergy = datum.rxn.calculate_ejectile_KE(ex.excitation)
-                ex.rho = datum.rxn.convert_ejectile_KE_2_rho(ex.kineticEnergy)
+                datum.rxn.set_target(self.targets[datum.rxn.targetMaterial.name])
+            keArray = datum.rxn.calculate_ejectile_KE_batch(np.array([ex.excitation for ex in datum.excitations]))
+            rhoArray = datum.rxn.convert_ejectile_KE_2_rho_batch(keArray)
+            zArray = datum.rxn.calculate_focal_plane_offset_batch(keArray)
+            for ex, ke, rho, z in zip(datum.excitations, keArray.tolist(), rhoArray.tolist(), zArray.tolist()):
+                ex.kineticEnergy = ke
+                ex.rho = rho
+                ex.fpZ = z
 
     def add_excitation(self, rxnName: str, excitation: float) -> None:
         if rxnName not in self.data:
@@ -1,9 +1,16 @@
 from .data.NuclearData import global_nuclear_data, NucleusData
 from .SPSTarget import SPSTarget
 from dataclasses import dataclass
+from typing import Optional
 from numpy import sqrt, cos, pi, sin
+import numpy as np
+from numpy.typing import NDArray
 
 INVALID_KINETIC_ENERGY: float = -1000.0
+INTERPOLANT_TOLERANCE: float = 1.0e-5 #MeV
+INTERPOLANT_NODES_MIN: int = 16
+INTERPOLANT_NODES_MAX: int = 16384
+INTERPOLANT_ERROR_SAFETY: float = 2.0 #factor applied to the largest error found at the check points
 
 @dataclass
 class RxnParameters:
@@ -14,6 +21,26 @@ class RxnParameters:
     magneticField: float = 0.0 #kG
     spsAngle: float = 0.0 #rad
 
+#Cubic spline of excitation (MeV) as a function of rho (cm) over [rhoMin, rhoMax], see Reaction.build_excitation_interpolant
+#maxError (MeV) is an estimated error bound, not a guaranteed one: the largest deviation from the exact calculation found at the quarter, half, and three-quarter
+#points of every spline interval, times INTERPOLANT_ERROR_SAFETY. It is a snapshot of the reaction: rebuild it if the reaction or target changes
+class ExcitationInterpolant:
+    def __init__(self, rho: NDArray[np.float64], excitation: NDArray[np.float64], maxError: float):
+        self.rhoMin = rho[0]
+        self.rhoMax = rho[-1]
+        from scipy.interpolate import CubicSpline #slow to import, and only needed here
+        self.spline = CubicSpline(rho, excitation)
+        self.maxError = maxError
+        self.nodes = len(rho)
+
+    #rho outside of [rhoMin, rhoMax] is NaN
+    def __call__(self, rho: NDArray[np.float64]) -> NDArray[np.float64]:
+        rho = np.asarray(rho, dtype=np.float64)
+        return np.where((rho >= self.rhoMin) & (rho <= self.rhoMax), self.spline(rho), np.nan)
+
+    def derivative(self, rho: NDArray[np.float64]) -> NDArray[np.float64]:
+        return self.spline(rho, 1)
+
 def create_reaction_parameters(zt: int, at: int, zp: int, ap: int, ze: int, ae: int) -> RxnParameters:
     return RxnParameters(global_nuclear_data.get_data(zt, at), global_nuclear_data.get_data(zp, ap), global_nuclear_data.get_data(ze, ae))
 
@@ -26,10 +53,31 @@ class Reaction:
     def __init__(self, params: RxnParameters, target: SPSTarget):
         self.params = params
         self.targetMaterial = target
+        self.beamRxnEnergy: Optional[float] = None #beam energy at the reaction point, see get_beam_rxn_energy
 
         self.rxnLayer = self.targetMaterial.get_rxn_layer(self.params.target.Z, self.params.target.A)
         self.setup_nuclei()
 
+    #reactions saved before the beam energy cache was added lack it; it is recalculated on first use
+    def __setstate__(self, state: dict) -> None:
+        self.beamRxnEnergy = None
+        self.__dict__.update(state)
+
+    def set_target(self, target: SPSTarget) -> None:
+        self.targetMaterial = target
+        self.rxnLayer = self.targetMaterial.get_rxn_layer(self.params.target.Z, self.params.target.A)
+        self.invalidate_beam_energy()
+
+    #The beam energy at the reaction point depends only on the beam, its energy, and the target; it is the same for every excitation or rho
+    #It is cached, and must be invalidated whenever one of those changes (update_parameters and set_target do this)
+    def get_beam_rxn_energy(self) -> float:
+        if self.beamRxnEnergy is None:
+            self.beamRxnEnergy = self.params.beamEnergy - self.targetMaterial.get_incoming_energyloss(self.params.projectile.Z, self.params.projectile.mass, self.params.beamEnergy, self.rxnLayer, 0.0)
+        return self.beamRxnEnergy
+
+    def invalidate_beam_energy(self) -> None:
+        self.beamRxnEnergy = None
+
     def setup_nuclei(self) -> None:
         residZ = self.params.target.Z + self.params.projectile.Z - self.params.ejectile.Z
         residA = self.params.target.A + self.params.projectile.A - self.params.ejectile.A
@@ -51,7 +99,7 @@ class Reaction:
     #MeV
     def calculate_ejectile_KE(self, excitation: float) -> float:
         rxnQ = self.Qvalue - excitation
-        beamRxnEnergy = self.params.beamEnergy - self.targetMaterial.get_incoming_energyloss(self.params.projectile.Z, self.params.projectile.mass, self.params.beamEnergy, self.rxnLayer, 0.0)
+        beamRxnEnergy = self.get_beam_rxn_energy()
         threshold = -rxnQ*(self.params.ejectile.mass+self.residual.mass)/(self.params.ejectile.mass + self.residual.mass - self.params.projectile.mass)
         if beamRxnEnergy < threshold:
             return INVALID_KINETIC_ENERGY
@@ -73,6 +121,32 @@ class Reaction:
         ejectileEnergy -= self.targetMaterial.get_outgoing_energyloss(self.params.ejectile.Z, self.params.ejectile.mass, ejectileEnergy, self.rxnLayer, self.params.spsAngle)
         return ejectileEnergy
 
+    #Ejectile kinetic energy (MeV) at the reaction point, before any energy loss, for arrays of beam energies at the reaction point (MeV)
+    #and excitations (MeV), which are broadcast against each other. Kinematically forbidden entries are INVALID_KINETIC_ENERGY
+    def calculate_ejectile_rxn_KE_batch(self, beamRxnEnergy: NDArray[np.float64], excitation: NDArray[np.float64]) -> NDArray[np.float64]:
+        beamRxnEnergy, excitation = np.broadcast_arrays(np.asarray(beamRxnEnergy, dtype=np.float64), np.asarray(excitation, dtype=np.float64))
+        rxnQ = self.Qvalue - excitation
+        threshold = -rxnQ*(self.params.ejectile.mass+self.residual.mass)/(self.params.ejectile.mass + self.residual.mass - self.params.projectile.mass)
+        term1 = np.sqrt(self.params.projectile.mass * self.params.ejectile.mass * beamRxnEnergy) / (self.params.ejectile.mass + self.residual.mass) * cos(self.params.spsAngle)
+        term2 = (beamRxnEnergy * (self.residual.mass - self.params.projectile.mass) + self.residual.mass * rxnQ) / (self.params.ejectile.mass + self.residual.mass)
+        isValid = (beamRxnEnergy >= threshold) & (term1**2.0 + term2 >= 0)
+
+        ejectileEnergy = np.full(beamRxnEnergy.shape, INVALID_KINETIC_ENERGY)
+        ejectileEnergy[isValid] = (term1[isValid] + np.sqrt(term1[isValid]**2.0 + term2[isValid]))**2.0
+        return ejectileEnergy
+
+    #Monte Carlo line shape of the ejectile kinetic energy (MeV) for a state, from nEvents events each reacting at a random depth in the
+    #reaction layer, with energy straggling in every layer (see SPSTarget.sample_incoming_energyloss). Invalid events are INVALID_KINETIC_ENERGY
+    def sample_ejectile_KE(self, excitation: float, nEvents: int, rng: Optional[np.random.Generator] = None) -> NDArray[np.float64]:
+        if rng is None:
+            rng = np.random.default_rng()
+        depths = self.targetMaterial.sample_reaction_depths(nEvents, rng)
+        beamRxnEnergy = self.params.beamEnergy - self.targetMaterial.sample_incoming_energyloss(self.params.projectile.Z, self.params.projectile.mass, self.params.beamEnergy, self.rxnLayer, 0.0, depths, rng)
+        ejectileEnergy = self.calculate_ejectile_rxn_KE_batch(beamRxnEnergy, excitation)
+        isValid = ejectileEnergy != INVALID_KINETIC_ENERGY
+        ejectileEnergy[isValid] -= self.targetMaterial.sample_outgoing_energyloss(self.params.ejectile.Z, self.params.ejectile.mass, ejectileEnergy[isValid], self.rxnLayer, self.params.spsAngle, depths[isValid], rng)
+        return ejectileEnergy
+
     def convert_ejectile_KE_2_rho(self, ejectileEnergy: float) -> float:
         if ejectileEnergy == INVALID_KINETIC_ENERGY:
             return 0.0
@@ -86,13 +160,58 @@ class Reaction:
         ejectileEnergy  = sqrt(ejectileP**2.0 + self.params.ejectile.mass**2.0) - self.params.ejectile.mass
         ejectileRxnEnergy = ejectileEnergy +  self.targetMaterial.get_outgoing_reverse_energyloss(self.params.ejectile.Z, self.params.ejectile.mass, ejectileEnergy, self.rxnLayer, self.params.spsAngle)
         ejectileRxnP = sqrt(ejectileRxnEnergy * (ejectileRxnEnergy + 2.0 * self.params.ejectile.mass))
-        beamRxnEnergy = self.params.beamEnergy - self.targetMaterial.get_incoming_energyloss(self.params.projectile.Z, self.params.projectile.mass, self.params.beamEnergy, self.rxnLayer, 0.0)
+        beamRxnEnergy = self.get_beam_rxn_energy()
         beamRxnP = sqrt(beamRxnEnergy * (beamRxnEnergy + 2.0 * self.params.projectile.mass))
 
         residRxnEnergy = beamRxnEnergy + self.params.projectile.mass + self.params.target.mass - ejectileRxnEnergy - self.params.ejectile.mass
         residRxnP2 = beamRxnP**2.0 + ejectileRxnP**2.0 - 2.0 * ejectileRxnP * beamRxnP * cos(self.params.spsAngle)
         return sqrt(residRxnEnergy**2.0 - residRxnP2) - self.residual.mass
 
+    #Array version of calculate_excitation, with the reverse energy loss of every entry integrated together
+    def calculate_excitation_batch(self, rho: NDArray[np.float64]) -> NDArray[np.float64]:
+        rho = np.asarray(rho, dtype=np.float64)
+        ejectileP = rho * float(self.params.ejectile.Z) * self.params.magneticField * self.QBRHO2P
+        ejectileEnergy = np.sqrt(ejectileP**2.0 + self.params.ejectile.mass**2.0) - self.params.ejectile.mass
+        ejectileRxnEnergy = ejectileEnergy + self.targetMaterial.get_outgoing_reverse_energyloss_batch(self.params.ejectile.Z, self.params.ejectile.mass, ejectileEnergy, self.rxnLayer, self.params.spsAngle)
+        ejectileRxnP = np.sqrt(ejectileRxnEnergy * (ejectileRxnEnergy + 2.0 * self.params.ejectile.mass))
+        beamRxnEnergy = self.get_beam_rxn_energy()
+        beamRxnP = sqrt(beamRxnEnergy * (beamRxnEnergy + 2.0 * self.params.projectile.mass))
+
+        residRxnEnergy = beamRxnEnergy + self.params.projectile.mass + self.params.target.mass - ejectileRxnEnergy - self.params.ejectile.mass
+        residRxnP2 = beamRxnP**2.0 + ejectileRxnP**2.0 - 2.0 * ejectileRxnP * beamRxnP * cos(self.params.spsAngle)
+        return np.sqrt(residRxnEnergy**2.0 - residRxnP2) - self.residual.mass
+
+    #Build an interpolant of calculate_excitation_batch over the rho acceptance [rhoMin, rhoMax] (cm), for converting very large numbers of rho values
+    #Nodes are doubled until the estimated error bound is within tolerance (MeV), or INTERPOLANT_NODES_MAX is reached; the achieved estimate is
+    #reported as maxError, with a warning if it is still above the tolerance
+    def build_excitation_interpolant(self, rhoMin: float, rhoMax: float, tolerance: float = INTERPOLANT_TOLERANCE) -> ExcitationInterpolant:
+        nodes = INTERPOLANT_NODES_MIN
+        rho = np.linspace(rhoMin, rhoMax, nodes)
+        excitation = self.calculate_excitation_batch(rho)
+        while True:
+            midpoints = 0.5 * (rho[1:] + rho[:-1])
+            exactMidpoints = self.calculate_excitation_batch(midpoints)
+            quarterpoints = np.concatenate((0.5 * (rho[:-1] + midpoints), 0.5 * (midpoints + rho[1:])))
+            interpolant = ExcitationInterpolant(rho, excitation, 0.0)
+            maxError = max(np.max(np.abs(interpolant(midpoints) - exactMidpoints)), np.max(np.abs(interpolant(quarterpoints) - self.calculate_excitation_batch(quarterpoints))))
+            interpolant.maxError = INTERPOLANT_ERROR_SAFETY * float(maxError)
+            if interpolant.maxError <= tolerance:
+                return interpolant
+            elif 2 * nodes - 1 > INTERPOLANT_NODES_MAX:
+                print(f"Warning! Excitation interpolant of {self!r} reached {nodes} nodes with an estimated error of {interpolant.maxError} MeV, above the tolerance of {tolerance} MeV")
+                return interpolant
+
+            #the midpoints are exactly the new nodes of the doubled grid
+            nodes = 2 * nodes - 1
+            newRho = np.empty(nodes)
+            newRho[0::2] = rho
+            newRho[1::2] = midpoints
+            newExcitation = np.empty(nodes)
+            newExcitation[0::2] = excitation
+            newExcitation[1::2] = exactMidpoints
+            rho = newRho
+            excitation = newExcitation
+
     def calculate_focal_plane_offset(self, ejectileEnergy: float) -> float:
         if ejectileEnergy == INVALID_KINETIC_ENERGY:
             return 0.0
@@ -101,8 +220,35 @@ class Reaction:
         k /= self.params.ejectile.mass + self.residual.mass - sqrt(self.params.projectile.mass * self.params.ejectile.mass * self.params.beamEnergy/ejectileEnergy) * cos(self.params.spsAngle)
         return -1.0*k*ejectileRho*self.FP_DISPERSION*self.FP_MAGNIFICATION
 
+    #Array versions of calculate_ejectile_KE, convert_ejectile_KE_2_rho, and calculate_focal_plane_offset, evaluated for every entry in one pass
+    #As with the scalar versions, kinematically forbidden entries have a kinetic energy of INVALID_KINETIC_ENERGY, and a rho and offset of 0.0
+    def calculate_ejectile_KE_batch(self, excitations: NDArray[np.float64]) -> NDArray[np.float64]:
+        ejectileEnergy = self.calculate_ejectile_rxn_KE_batch(self.get_beam_rxn_energy(), excitations)
+        isValid = ejectileEnergy != INVALID_KINETIC_ENERGY
+        ejectileEnergy[isValid] -= self.targetMaterial.get_outgoing_energyloss_batch(self.params.ejectile.Z, self.params.ejectile.mass, ejectileEnergy[isValid], self.rxnLayer, self.params.spsAngle)
+        return ejectileEnergy
+
+    def convert_ejectile_KE_2_rho_batch(self, ejectileEnergy: NDArray[np.float64]) -> NDArray[np.float64]:
+        ejectileEnergy = np.asarray(ejectileEnergy, dtype=np.float64)
+        isValid = ejectileEnergy != INVALID_KINETIC_ENERGY
+        rho = np.zeros(ejectileEnergy.shape)
+        p = np.sqrt(ejectileEnergy[isValid] * (ejectileEnergy[isValid] + 2.0 * self.params.ejectile.mass))
+        rho[isValid] = p / self.QBRHO2P / (float(self.params.ejectile.Z) * self.params.magneticField)
+        return rho
+
+    def calculate_focal_plane_offset_batch(self, ejectileEnergy: NDArray[np.float64]) -> NDArray[np.float64]:
+        ejectileEnergy = np.asarray(ejectileEnergy, dtype=np.float64)
+        isValid = ejectileEnergy != INVALID_KINETIC_ENERGY
+        offset = np.zeros(ejectileEnergy.shape)
+        ejectileRho = self.convert_ejectile_KE_2_rho_batch(ejectileEnergy[isValid])
+        ratio = np.sqrt(self.params.projectile.mass * self.params.ejectile.mass * self.params.beamEnergy / ejectileEnergy[isValid])
+        k = ratio * sin(self.params.spsAngle) / (self.params.ejectile.mass + self.residual.mass - ratio * cos(self.params.spsAngle))
+        offset[isValid] = -1.0*k*ejectileRho*self.FP_DISPERSION*self.FP_MAGNIFICATION
+        return offset
+
     #(MeV, rad, kG)
     def update_parameters(self, beamEnergy: float, spsAngle: float, magenticField: float):
         self.params.beamEnergy = beamEnergy
         self.params.spsAngle = spsAngle
-        self.params.magneticField = magenticField
\ No newline at end of file
+        self.params.magneticField = magenticField
+        self.invalidate_beam_energy()
\ No newline at end of file
@@ -1,11 +1,75 @@
 from .data.NuclearData import global_nuclear_data
+from .data.DiskCache import DiskCache, generate_cache_key
+from .RangeTable import RangeTable, build_range_table, RANGE_TABLE_ENERGY_MIN, RANGE_TABLE_ENERGY_MAX, RANGE_TABLE_POINTS
 import pycatima as catima
 from dataclasses import dataclass, field
+from enum import Enum
+from typing import Optional
 from numpy import pi, cos
+import numpy as np
+from numpy.typing import NDArray
 
 INVALID_RXN_LAYER: int = -1
 ADAPTIVE_DEPTH_MAX: int = 100
 ENERGY_PERCENT_STEP_MIN: float = 0.001
+BATCH_STEPS_MIN: int = 4
+BATCH_STEPS_MAX: int = 10000
+ENERGY_STOPPED_MIN: float = 1.0e-3 #MeV/u, lowest energy in catima's tables; batch integrators treat particles below it as stopped
+#Maximum relative deviation of a range table energy loss from the adaptive integrator (see validate_range_table)
+#This is dominated by the step size of the integrator itself, the table is the more accurate of the two
+RANGE_TABLE_TOLERANCE: float = 1.0e-3
+#Local error tolerance of the adaptive Runge-Kutta integrator, per step: absolute (MeV/u) + relative * energy
+RK45_ABSOLUTE_TOLERANCE: float = 1.0e-10
+RK45_RELATIVE_TOLERANCE: float = 1.0e-8
+RK45_STEP_MIN: float = 1.0e-12 #fraction of the path length, below which a particle is considered stopped
+RK45_ITERATIONS_MAX: int = 10000
+STRAGGLING_GRID_POINTS: int = 16 #energies at which catima's straggling width is evaluated per layer, then interpolated
+FWHM_PER_SIGMA: float = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+#Dormand-Prince 5(4) embedded Runge-Kutta tableau. dE/dx does not depend on x, so the nodes (c) are not needed
+#The last row of RK45_A is the fifth order solution, so its slope is the first slope of the next step (first same as last)
+RK45_A: tuple[tuple[float, ...], ...] = (
+    (),
+    (1.0/5.0,),
+    (3.0/40.0, 9.0/40.0),
+    (44.0/45.0, -56.0/15.0, 32.0/9.0),
+    (19372.0/6561.0, -25360.0/2187.0, 64448.0/6561.0, -212.0/729.0),
+    (9017.0/3168.0, -355.0/33.0, 46732.0/5247.0, 49.0/176.0, -5103.0/18656.0),
+    (35.0/384.0, 0.0, 500.0/1113.0, 125.0/192.0, -2187.0/6784.0, 11.0/84.0)
+)
+#Difference between the fifth and fourth order weights, which gives the local error estimate
+RK45_ERROR_WEIGHTS: tuple[float, ...] = (71.0/57600.0, 0.0, -71.0/16695.0, 71.0/1920.0, -17253.0/339200.0, 22.0/525.0, -1.0/40.0)
+
+class EnergyLossMethod(Enum):
+    INTEGRATOR = "Integrator"
+    RANGE_TABLE = "RangeTable"
+    ADAPTIVE_RK45 = "AdaptiveRK45"
+
+@dataclass
+class IntegrationStats:
+    steps: int = 0 #accepted steps
+    rejectedSteps: int = 0
+    dedxCalls: int = 0
+    errorEstimate: float = 0.0 #sum of the local error estimates of the accepted steps, MeV/u
+
+#Method used by targets which do not request a specific one
+default_energyloss_method: EnergyLossMethod = EnergyLossMethod.INTEGRATOR
+
+def set_default_energyloss_method(method: EnergyLossMethod) -> None:
+    global default_energyloss_method
+    default_energyloss_method = method
+
+#Range tables are persisted here, so that reopening a project with the same targets does not rebuild them. None disables the disk cache
+range_table_cache: Optional[DiskCache] = DiskCache("rangetables")
+
+def set_range_table_cache(cache: Optional[DiskCache]) -> None:
+    global range_table_cache
+    range_table_cache = cache
+
+#Everything other than the target and projectile which changes the contents of a range table
+def get_range_table_settings() -> tuple:
+    config = catima.Config()
+    return (config.z_effective, config.corrections, config.calculation, config.low_energy, RANGE_TABLE_ENERGY_MIN, RANGE_TABLE_ENERGY_MAX, RANGE_TABLE_POINTS)
 
 @dataclass
 class TargetLayer:
@@ -90,19 +154,217 @@ def get_energyloss(projectile: catima.Projectile, material: catima.Material) ->
             e_final -= e_step
             projectile.T(e_final)
             x_traversed += x_step
-        
-    
+
+#integrate energy loss (or gain, direction=+1.0) for an array of energies (MeV/u), each through its own path length (g/cm^2)
+#each entry takes a fixed number of equal steps, chosen so that its relative energy step is below ENERGY_PERCENT_STEP_MIN
+#catima's dedx_from_range accepts a list of energies, so each step is a single call for all entries which still have steps to take
+#returns the total energy change (MeV/u) for each entry
+def integrate_energyloss_batch(projectile: catima.Projectile, material: catima.Material, energies: NDArray[np.float64], pathLengths: NDArray[np.float64], direction: float) -> NDArray[np.float64]:
+    energies, pathLengths = np.broadcast_arrays(np.asarray(energies, dtype=np.float64), np.asarray(pathLengths, dtype=np.float64))
+    result = np.zeros(energies.shape)
+    valid = (pathLengths > 0.0) & (energies > 0.0)
+    if not np.any(valid):
+        return result
+
+    A_recip = 1.0/projectile.A()
+    e_current = energies[valid]
+    dedx = np.array(catima.dedx_from_range(projectile, e_current.tolist(), material))
+    e_fraction = dedx * pathLengths[valid] * A_recip / e_current
+    nsteps = np.clip(np.ceil(e_fraction / ENERGY_PERCENT_STEP_MIN), BATCH_STEPS_MIN, BATCH_STEPS_MAX).astype(np.int64)
+    x_step = pathLengths[valid] / nsteps
+    for step in range(int(np.max(nsteps))):
+        moving = (nsteps > step) & (e_current > 0.0) #particles which stop in the material lose all of their energy
+        if step != 0:
+            dedx[moving] = catima.dedx_from_range(projectile, e_current[moving].tolist(), material)
+        e_current[moving] += direction * dedx[moving] * x_step[moving] * A_recip
+        e_current[e_current < ENERGY_STOPPED_MIN] = 0.0
+
+    result[valid] = np.abs(e_current - energies[valid])
+    return result
+
+#integrate energy loss (or gain, direction=+1.0) with an embedded Runge-Kutta (Dormand-Prince 5(4)) scheme
+#the step size shrinks or grows to keep the local error estimate within RK45_ABSOLUTE_TOLERANCE + RK45_RELATIVE_TOLERANCE * energy,
+#so thick layers need far fewer dedx evaluations than the Euler integrator for the same accuracy
+#returns the total energy change through the material (MeV/u), and accumulates the work done into stats
+def integrate_energyloss_rk45(projectile: catima.Projectile, material: catima.Material, direction: float, stats: IntegrationStats) -> float:
+    thickness = material.thickness() #g/cm^2
+    if thickness <= 0.0:
+        return 0.0
+
+    A_recip = 1.0/projectile.A()
+    e_start = projectile.T() #MeV/u
+    e_current = e_start
+    x_traversed = 0.0
+    x_step = thickness
+
+    def slope(energy: float) -> float:
+        projectile.T(energy)
+        stats.dedxCalls += 1
+        return direction * catima.dedx(projectile, material) * A_recip
+
+    k_first = slope(e_current)
+    for _ in range(RK45_ITERATIONS_MAX):
+        if thickness - x_traversed <= RK45_STEP_MIN * thickness:
+            break
+
+        x_step = min(x_step, thickness - x_traversed)
+        slopes = [k_first]
+        e_stage = e_current
+        for weights in RK45_A[1:]:
+            e_stage = e_current + x_step * sum(w * k for w, k in zip(weights, slopes))
+            if e_stage < ENERGY_STOPPED_MIN:
+                break
+            slopes.append(slope(e_stage))
+
+        #a stage stepped past the end of the particle's range, retry with a smaller step
+        if e_stage < ENERGY_STOPPED_MIN:
+            stats.rejectedSteps += 1
+            x_step *= 0.5
+            if x_step < RK45_STEP_MIN * thickness:
+                projectile.T(0.0)
+                return e_start
+            continue
+
+        error = abs(x_step * sum(w * k for w, k in zip(RK45_ERROR_WEIGHTS, slopes)))
+        tolerance = RK45_ABSOLUTE_TOLERANCE + RK45_RELATIVE_TOLERANCE * abs(e_stage)
+        if error <= tolerance:
+            stats.steps += 1
+            stats.errorEstimate += error
+            x_traversed += x_step
+            e_current = e_stage
+            k_first = slopes[-1]
+        else:
+            stats.rejectedSteps += 1
+
+        factor = 0.9 * (tolerance / error)**0.2 if error > 0.0 else 5.0
+        x_step *= min(5.0, max(0.2, factor))
+
+    projectile.T(e_current)
+    return abs(e_current - e_start)
+
+def get_energyloss_rk45(projectile: catima.Projectile, material: catima.Material, stats: Optional[IntegrationStats] = None) -> float:
+    return integrate_energyloss_rk45(projectile, material, -1.0, stats if stats is not None else IntegrationStats())
+
+def get_reverse_energyloss_rk45(projectile: catima.Projectile, material: catima.Material, stats: Optional[IntegrationStats] = None) -> float:
+    return integrate_energyloss_rk45(projectile, material, 1.0, stats if stats is not None else IntegrationStats())
+
+#batch version of integrate_energyloss_rk45. Every entry keeps its own step size; each stage evaluates dedx for all unfinished entries at once
+def integrate_energyloss_batch_rk45(projectile: catima.Projectile, material: catima.Material, energies: NDArray[np.float64], pathLengths: NDArray[np.float64], direction: float, stats: IntegrationStats) -> NDArray[np.float64]:
+    energies, pathLengths = np.broadcast_arrays(np.asarray(energies, dtype=np.float64), np.asarray(pathLengths, dtype=np.float64))
+    result = np.zeros(energies.shape)
+    valid = (pathLengths > 0.0) & (energies > 0.0)
+    if not np.any(valid):
+        return result
+
+    A_recip = 1.0/projectile.A()
+    def slope(e: NDArray[np.float64]) -> NDArray[np.float64]:
+        stats.dedxCalls += 1
+        return direction * np.array(catima.dedx_from_range(projectile, e.tolist(), material)) * A_recip
+
+    paths = pathLengths[valid]
+    e_current = energies[valid]
+    x_traversed = np.zeros(len(paths))
+    x_step = paths.copy()
+    k_first = slope(e_current)
+    active = np.ones(len(paths), dtype=bool)
+    for _ in range(RK45_ITERATIONS_MAX):
+        indices = np.nonzero(active)[0]
+        if len(indices) == 0:
+            break
+
+        e_start = e_current[indices]
+        steps = np.minimum(x_step[indices], paths[indices] - x_traversed[indices])
+        slopes = [k_first[indices]]
+        isGood = np.ones(len(indices), dtype=bool)
+        for weights in RK45_A[1:]:
+            e_stage = e_start + steps * sum(w * k for w, k in zip(weights, slopes))
+            isGood &= e_stage >= ENERGY_STOPPED_MIN
+            slopes.append(slope(np.where(isGood, e_stage, e_start)))
+
+        error = np.abs(steps * sum(w * k for w, k in zip(RK45_ERROR_WEIGHTS, slopes)))
+        tolerance = RK45_ABSOLUTE_TOLERANCE + RK45_RELATIVE_TOLERANCE * np.abs(e_stage)
+        accepted = isGood & (error <= tolerance)
+        stats.steps += int(np.count_nonzero(accepted))
+        stats.rejectedSteps += len(indices) - int(np.count_nonzero(accepted))
+        stats.errorEstimate += float(np.sum(error[accepted]))
+
+        accepted_indices = indices[accepted]
+        x_traversed[accepted_indices] += steps[accepted]
+        e_current[accepted_indices] = e_stage[accepted]
+        k_first[accepted_indices] = slopes[-1][accepted]
+
+        with np.errstate(divide="ignore"):
+            factor = np.clip(0.9 * (tolerance / error)**0.2, 0.2, 5.0)
+        x_step[indices] = steps * np.where(isGood, factor, 0.5)
+
+        #entries whose step collapsed while trying to step past the end of their range have stopped
+        stopped = indices[~isGood & (x_step[indices] < RK45_STEP_MIN * paths[indices])]
+        e_current[stopped] = 0.0
+        active[stopped] = False
+        active[indices] &= paths[indices] - x_traversed[indices] > RK45_STEP_MIN * paths[indices]
+
+    result[valid] = np.abs(e_current - energies[valid])
+    return result
+
+#batch version of get_energyloss, returns the energy loss (MeV/u) for each initial energy (MeV/u)
+def get_energyloss_batch(projectile: catima.Projectile, material: catima.Material, energies: NDArray[np.float64], pathLengths: NDArray[np.float64]) -> NDArray[np.float64]:
+    return integrate_energyloss_batch(projectile, material, energies, pathLengths, -1.0)
+
+#batch version of get_reverse_energyloss, returns the energy gain (MeV/u) for each final energy (MeV/u)
+def get_reverse_energyloss_batch(projectile: catima.Projectile, material: catima.Material, energies: NDArray[np.float64], pathLengths: NDArray[np.float64]) -> NDArray[np.float64]:
+    return integrate_energyloss_batch(projectile, material, energies, pathLengths, 1.0)
+
+#Compare a range table against the adaptive integrator for a set of initial energies (MeV/u) through the material thickness
+#returns the largest relative deviation of the forward and reverse energy losses, to be compared with RANGE_TABLE_TOLERANCE
+def validate_range_table(table: RangeTable, projectile: catima.Projectile, material: catima.Material, energies: NDArray[np.float64]) -> float:
+    maxDeviation = 0.0
+    for e in energies:
+        projectile.T(e)
+        integrated = get_energyloss(projectile, material)
+        tabulated = float(table.get_energyloss(e, material.thickness()))
+        if integrated > 0.0:
+            maxDeviation = max(maxDeviation, abs(tabulated - integrated)/integrated)
+        projectile.T(e)
+        integrated = get_reverse_energyloss(projectile, material)
+        tabulated = float(table.get_reverse_energyloss(e, material.thickness()))
+        if integrated > 0.0:
+            maxDeviation = max(maxDeviation, abs(tabulated - integrated)/integrated)
+    return maxDeviation
+
+#FWHM of a sampled distribution, assuming it is approximately Gaussian
+def get_fwhm(samples: NDArray[np.float64]) -> float:
+    return FWHM_PER_SIGMA * float(np.std(samples))
 
 class SPSTarget:
     MEV2U: float = 1.0/931.493614838475
     UG2G: float = 1.0e-6 #convert ug to g
-    def __init__(self, layers: list[TargetLayer], name: str = "default"):
+    def __init__(self, layers: list[TargetLayer], name: str = "default", energylossMethod: Optional[EnergyLossMethod] = None):
         self.layer_details = layers
         self.name = name
+        self.energylossMethod = energylossMethod #None -> use default_energyloss_method
+        self.rangeTables: dict[tuple[float, float, tuple[tuple[int, int, int], ...]], RangeTable] = {}
+        self.materialCache: dict[int, tuple[tuple[tuple[tuple[int, int, int], ...], float], catima.Material]] = {}
+        self.integrationStats = IntegrationStats() #work done by the ADAPTIVE_RK45 method
+
+    #targets saved before the energy loss methods and caches were added lack their attributes; start those from the defaults
+    def __setstate__(self, state: dict) -> None:
+        self.__init__([])
+        self.__dict__.update(state)
+
+    def reset_integration_stats(self) -> None:
+        self.integrationStats = IntegrationStats()
 
     def __str__(self):
         return self.name
 
+    #catima objects cannot be pickled (saving a project, sending a target to a worker process), so the material cache is dropped
+    #The range tables are large (MB) and are dropped too: they are reloaded from range_table_cache, or rebuilt, when next needed
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["materialCache"] = {}
+        state["rangeTables"] = {}
+        return state
+
     def get_rxn_layer(self, zt: int, at: int) -> int:
         for idx, layer in enumerate(self.layer_details):
             for (z, a, s) in layer.compound_list:
@@ -110,6 +372,95 @@ class SPSTarget:
                     return idx
         return INVALID_RXN_LAYER
 
+    def get_energyloss_method(self) -> EnergyLossMethod:
+        if self.energylossMethod is None:
+            return default_energyloss_method
+        return self.energylossMethod
+
+    #Materials are cached per layer and rebuilt only when the layer's compound list or thickness changes
+    #Callers set the path length through the material with material.thickness(), so angles do not require a new material
+    def get_layer_material(self, layer_idx: int) -> catima.Material:
+        layer = self.layer_details[layer_idx]
+        fingerprint = (tuple(layer.compound_list), layer.thickness)
+        cached = self.materialCache.get(layer_idx, None)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+        material = catima.Material([(global_nuclear_data.get_data(z, a).mass * self.MEV2U, z, float(s)) for (z, a, s) in layer.compound_list])
+        self.materialCache[layer_idx] = (fingerprint, material)
+        return material
+
+    def clear_material_cache(self) -> None:
+        self.materialCache.clear()
+
+    #Range tables are built once per projectile and layer material, and reused for every thickness and angle
+    def get_range_table(self, projectile: catima.Projectile, layer_idx: int) -> RangeTable:
+        key = (projectile.Z(), projectile.A(), tuple(self.layer_details[layer_idx].compound_list))
+        table = self.rangeTables.get(key, None)
+        if table is None:
+            self.load_range_tables(projectile)
+            table = self.rangeTables[key]
+        return table
+
+    def get_range_table_cache_key(self, projectile: catima.Projectile) -> str:
+        layers = [(tuple(layer.compound_list), layer.thickness) for layer in self.layer_details]
+        return generate_cache_key((layers, projectile.Z(), projectile.A(), get_range_table_settings()))
+
+    #Load the tables of every layer for this projectile from the disk cache, or build them and store them there
+    def load_range_tables(self, projectile: catima.Projectile) -> None:
+        cacheKey = self.get_range_table_cache_key(projectile)
+        arrays = range_table_cache.load(cacheKey) if range_table_cache is not None else None
+        isBuilt = False
+        for idx, layer in enumerate(self.layer_details):
+            key = (projectile.Z(), projectile.A(), tuple(layer.compound_list))
+            if arrays is not None:
+                self.rangeTables[key] = RangeTable(arrays[f"energy{idx}"], arrays[f"dedx{idx}"], float(arrays["A"]))
+            elif key not in self.rangeTables:
+                self.rangeTables[key] = build_range_table(catima.Projectile(projectile.A(), projectile.Z()), self.get_layer_material(idx))
+                isBuilt = True
+
+        if isBuilt and range_table_cache is not None:
+            arrays = {"A": np.array(projectile.A())}
+            for idx, layer in enumerate(self.layer_details):
+                table = self.rangeTables[(projectile.Z(), projectile.A(), tuple(layer.compound_list))]
+                arrays[f"energy{idx}"] = table.energy
+                arrays[f"dedx{idx}"] = table.dedx
+            range_table_cache.store(cacheKey, arrays)
+
+    #Energy loss (MeV/u) of the projectile, at its current energy, along a path (g/cm^2) through a layer
+    def get_layer_energyloss(self, projectile: catima.Projectile, layer_idx: int, pathLength: float) -> float:
+        if self.get_energyloss_method() == EnergyLossMethod.RANGE_TABLE:
+            return float(self.get_range_table(projectile, layer_idx).get_energyloss(projectile.T(), pathLength))
+        material = self.get_layer_material(layer_idx)
+        material.thickness(pathLength)
+        if self.get_energyloss_method() == EnergyLossMethod.ADAPTIVE_RK45:
+            return get_energyloss_rk45(projectile, material, self.integrationStats)
+        return get_energyloss(projectile, material)
+
+    #Energy gain (MeV/u) of the projectile, at its current (final) energy, along a path (g/cm^2) through a layer
+    def get_layer_reverse_energyloss(self, projectile: catima.Projectile, layer_idx: int, pathLength: float) -> float:
+        if self.get_energyloss_method() == EnergyLossMethod.RANGE_TABLE:
+            return float(self.get_range_table(projectile, layer_idx).get_reverse_energyloss(projectile.T(), pathLength))
+        material = self.get_layer_material(layer_idx)
+        material.thickness(pathLength)
+        if self.get_energyloss_method() == EnergyLossMethod.ADAPTIVE_RK45:
+            return get_reverse_energyloss_rk45(projectile, material, self.integrationStats)
+        return get_reverse_energyloss(projectile, material)
+
+    def get_layer_energyloss_batch(self, projectile: catima.Projectile, layer_idx: int, energies: NDArray[np.float64], pathLengths: NDArray[np.float64]) -> NDArray[np.float64]:
+        if self.get_energyloss_method() == EnergyLossMethod.RANGE_TABLE:
+            return self.get_range_table(projectile, layer_idx).get_energyloss(energies, pathLengths)
+        elif self.get_energyloss_method() == EnergyLossMethod.ADAPTIVE_RK45:
+            return integrate_energyloss_batch_rk45(projectile, self.get_layer_material(layer_idx), energies, pathLengths, -1.0, self.integrationStats)
+        return get_energyloss_batch(projectile, self.get_layer_material(layer_idx), energies, pathLengths)
+
+    def get_layer_reverse_energyloss_batch(self, projectile: catima.Projectile, layer_idx: int, energies: NDArray[np.float64], pathLengths: NDArray[np.float64]) -> NDArray[np.float64]:
+        if self.get_energyloss_method() == EnergyLossMethod.RANGE_TABLE:
+            return self.get_range_table(projectile, layer_idx).get_reverse_energyloss(energies, pathLengths)
+        elif self.get_energyloss_method() == EnergyLossMethod.ADAPTIVE_RK45:
+            return integrate_energyloss_batch_rk45(projectile, self.get_layer_material(layer_idx), energies, pathLengths, 1.0, self.integrationStats)
+        return get_reverse_energyloss_batch(projectile, self.get_layer_material(layer_idx), energies, pathLengths)
+
     #Calculate energy loss for a particle coming into the target, up to rxn layer (halfway through rxn layer)
     def get_incoming_energyloss(self, zp: int, ap: float, e_initial: float, rxn_layer: int, angle: float) -> float:
         if angle == pi*0.5:
@@ -119,15 +470,12 @@ class SPSTarget:
         projectile = catima.Projectile(ap_u, zp)
         e_current = e_initial/ap_u
         for (idx, layer) in enumerate(self.layer_details):
-            material = catima.Material([(global_nuclear_data.get_data(z, a).mass * self.MEV2U, z, float(s)) for (z, a, s) in layer.compound_list])
             projectile.T(e_current) #catima wants MeV/u
             if idx == rxn_layer:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle))))
-                e_current -= get_energyloss(projectile, material)
+                e_current -= self.get_layer_energyloss(projectile, idx, layer.thickness * self.UG2G / (2.0 * abs(cos(angle))))
                 return e_initial - e_current*ap_u
             else:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / abs(cos(angle)))
-                e_current -= get_energyloss(projectile, material)
+                e_current -= self.get_layer_energyloss(projectile, idx, layer.thickness * self.UG2G / abs(cos(angle)))
 
         return e_initial - e_current*ap_u
 
@@ -141,13 +489,11 @@ class SPSTarget:
         e_current = e_initial/ap_u
 
         for (idx, layer) in enumerate(self.layer_details[rxn_layer:], start=rxn_layer):
-            material = catima.Material([(global_nuclear_data.get_data(z, a).mass * self.MEV2U, z, float(s)) for (z, a, s) in layer.compound_list])
             projectile.T(e_current) #catima wants MeV/u
             if idx == rxn_layer:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle))))
+                e_current -= self.get_layer_energyloss(projectile, idx, layer.thickness * self.UG2G / (2.0 * abs(cos(angle))))
             else:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / abs(cos(angle)))
-            e_current -= get_energyloss(projectile, material)
+                e_current -= self.get_layer_energyloss(projectile, idx, layer.thickness * self.UG2G / abs(cos(angle)))
 
         return e_initial - e_current*ap_u
 
@@ -160,15 +506,135 @@ class SPSTarget:
         projectile = catima.Projectile(ap_u, zp)
         e_current = e_final/ap_u
         sublist = self.layer_details[rxn_layer:] #only care about rxn_layer -> exit
-        reveresedRxnLayer = len(sublist) -1 #when reversed rxn_layer is the last layer
-        for (idx, layer) in reversed(list(enumerate(sublist))):
-            material = catima.Material([(global_nuclear_data.get_data(z, a).mass * self.MEV2U, z, float(s)) for (z, a, s) in layer.compound_list])
+        for (idx, layer) in reversed(list(enumerate(sublist, start=rxn_layer))): #when reversed rxn_layer is the last layer
             projectile.T(e_current) #catima wants MeV/u
-            if idx == reveresedRxnLayer:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / (2.0 * abs(cos(angle))))
+            if idx == rxn_layer:
+                e_current += self.get_layer_reverse_energyloss(projectile, idx, layer.thickness * self.UG2G / (2.0 * abs(cos(angle))))
             else:
-                material.thickness(self.layer_details[idx].thickness * self.UG2G / abs(cos(angle)))
-            e_current += get_reverse_energyloss(projectile, material)
+                e_current += self.get_layer_reverse_energyloss(projectile, idx, layer.thickness * self.UG2G / abs(cos(angle)))
 
         return e_current*ap_u - e_final
 
+    #Batch versions of the energy loss methods above. Energies (MeV) and angles (rad) can be arrays (angles may also be a single value)
+    #and are broadcast against each other. Each layer is integrated once for the whole array, rather than once per energy
+    def get_incoming_energyloss_batch(self, zp: int, ap: float, e_initial: NDArray[np.float64], rxn_layer: int, angle: NDArray[np.float64] | float = 0.0) -> NDArray[np.float64]:
+        e_initial, angle = np.broadcast_arrays(np.asarray(e_initial, dtype=np.float64), np.asarray(angle, dtype=np.float64))
+        isNormal = angle == pi*0.5
+        pathScale = np.where(isNormal, 0.0, 1.0 / np.abs(cos(angle)))
+
+        ap_u = ap * self.MEV2U
+        projectile = catima.Projectile(ap_u, zp)
+        e_current = e_initial/ap_u
+        for (idx, layer) in enumerate(self.layer_details):
+            if idx == rxn_layer:
+                e_current = e_current - self.get_layer_energyloss_batch(projectile, idx, e_current, layer.thickness * self.UG2G * 0.5 * pathScale)
+                break
+            else:
+                e_current = e_current - self.get_layer_energyloss_batch(projectile, idx, e_current, layer.thickness * self.UG2G * pathScale)
+
+        return np.where(isNormal, e_initial, e_initial - e_current*ap_u)
+
+    def get_outgoing_energyloss_batch(self, zp: int, ap: float, e_initial: NDArray[np.float64], rxn_layer: int, angle: NDArray[np.float64] | float) -> NDArray[np.float64]:
+        e_initial, angle = np.broadcast_arrays(np.asarray(e_initial, dtype=np.float64), np.asarray(angle, dtype=np.float64))
+        isNormal = angle == pi*0.5
+        pathScale = np.where(isNormal, 0.0, 1.0 / np.abs(cos(angle)))
+
+        ap_u = ap * self.MEV2U
+        projectile = catima.Projectile(ap_u, zp)
+        e_current = e_initial/ap_u
+        for (idx, layer) in enumerate(self.layer_details[rxn_layer:], start=rxn_layer):
+            if idx == rxn_layer:
+                e_current = e_current - self.get_layer_energyloss_batch(projectile, idx, e_current, layer.thickness * self.UG2G * 0.5 * pathScale)
+            else:
+                e_current = e_current - self.get_layer_energyloss_batch(projectile, idx, e_current, layer.thickness * self.UG2G * pathScale)
+
+        return np.where(isNormal, e_initial, e_initial - e_current*ap_u)
+
+    def get_outgoing_reverse_energyloss_batch(self, zp: int, ap: float, e_final: NDArray[np.float64], rxn_layer: int, angle: NDArray[np.float64] | float) -> NDArray[np.float64]:
+        e_final, angle = np.broadcast_arrays(np.asarray(e_final, dtype=np.float64), np.asarray(angle, dtype=np.float64))
+        isNormal = angle == pi*0.5
+        pathScale = np.where(isNormal, 0.0, 1.0 / np.abs(cos(angle)))
+
+        ap_u = ap * self.MEV2U
+        projectile = catima.Projectile(ap_u, zp)
+        e_current = e_final/ap_u
+        for (idx, layer) in reversed(list(enumerate(self.layer_details[rxn_layer:], start=rxn_layer))):
+            if idx == rxn_layer:
+                e_current = e_current + self.get_layer_reverse_energyloss_batch(projectile, idx, e_current, layer.thickness * self.UG2G * 0.5 * pathScale)
+            else:
+                e_current = e_current + self.get_layer_reverse_energyloss_batch(projectile, idx, e_current, layer.thickness * self.UG2G * pathScale)
+
+        return np.where(isNormal, 0.0, e_current*ap_u - e_final)
+
+    #Energy straggling width (MeV/u, one sigma) of the projectile at the given energies (MeV/u) along the given path lengths (g/cm^2) through a layer
+    #catima's width is evaluated for the longest path on a small energy grid, then interpolated in energy and scaled by sqrt(path)
+    def get_layer_straggling_batch(self, projectile: catima.Projectile, layer_idx: int, energies: NDArray[np.float64], pathLengths: NDArray[np.float64]) -> NDArray[np.float64]:
+        energies, pathLengths = np.broadcast_arrays(np.asarray(energies, dtype=np.float64), np.asarray(pathLengths, dtype=np.float64))
+        sigmas = np.zeros(energies.shape)
+        valid = (pathLengths > 0.0) & (energies > ENERGY_STOPPED_MIN)
+        if not np.any(valid):
+            return sigmas
+
+        referencePath = np.max(pathLengths[valid])
+        material = self.get_layer_material(layer_idx)
+        material.thickness(referencePath)
+        energyGrid = np.geomspace(np.min(energies[valid]), np.max(energies[valid]), STRAGGLING_GRID_POINTS)
+        sigmaGrid = np.empty(len(energyGrid))
+        for index, e in enumerate(energyGrid):
+            projectile.T(e)
+            sigmaGrid[index] = catima.calculate(projectile, material).sigma_E
+        sigmas[valid] = np.interp(energies[valid], energyGrid, sigmaGrid) * np.sqrt(pathLengths[valid] / referencePath)
+        return sigmas
+
+    #Fraction of the way through the reaction layer at which each event reacts, uniformly distributed
+    def sample_reaction_depths(self, nEvents: int, rng: Optional[np.random.Generator] = None) -> NDArray[np.float64]:
+        if rng is None:
+            rng = np.random.default_rng()
+        return rng.uniform(0.0, 1.0, nEvents)
+
+    #Monte Carlo versions of get_incoming_energyloss and get_outgoing_energyloss. Rather than reacting at the middle of the reaction layer,
+    #each event reacts at its own depth (fraction of the layer, see sample_reaction_depths) and has the energy straggling of each layer applied
+    #Returns the energy loss (MeV) of every event, all events being handled together layer by layer
+    def sample_incoming_energyloss(self, zp: int, ap: float, e_initial: float, rxn_layer: int, angle: float, depths: NDArray[np.float64], rng: Optional[np.random.Generator] = None) -> NDArray[np.float64]:
+        if rng is None:
+            rng = np.random.default_rng()
+        depths = np.asarray(depths, dtype=np.float64)
+        if angle == pi*0.5:
+            return np.full(depths.shape, e_initial)
+
+        ap_u = ap * self.MEV2U
+        projectile = catima.Projectile(ap_u, zp)
+        e_current = np.full(depths.shape, e_initial/ap_u)
+        for (idx, layer) in enumerate(self.layer_details):
+            if idx == rxn_layer:
+                pathLengths = layer.thickness * self.UG2G * depths / abs(cos(angle))
+            else:
+                pathLengths = np.full(depths.shape, layer.thickness * self.UG2G / abs(cos(angle)))
+            sigmas = self.get_layer_straggling_batch(projectile, idx, e_current, pathLengths)
+            e_current = e_current - self.get_layer_energyloss_batch(projectile, idx, e_current, pathLengths) + rng.normal(0.0, 1.0, depths.shape) * sigmas
+            e_current = np.maximum(e_current, 0.0)
+            if idx == rxn_layer:
+                break
+
+        return e_initial - e_current*ap_u
+
+    def sample_outgoing_energyloss(self, zp: int, ap: float, e_initial: NDArray[np.float64], rxn_layer: int, angle: float, depths: NDArray[np.float64], rng: Optional[np.random.Generator] = None) -> NDArray[np.float64]:
+        if rng is None:
+            rng = np.random.default_rng()
+        e_initial, depths = np.broadcast_arrays(np.asarray(e_initial, dtype=np.float64), np.asarray(depths, dtype=np.float64))
+        if angle == pi*0.5:
+            return e_initial.copy()
+
+        ap_u = ap * self.MEV2U
+        projectile = catima.Projectile(ap_u, zp)
+        e_current = e_initial/ap_u
+        for (idx, layer) in enumerate(self.layer_details[rxn_layer:], start=rxn_layer):
+            if idx == rxn_layer:
+                pathLengths = layer.thickness * self.UG2G * (1.0 - depths) / abs(cos(angle))
+            else:
+                pathLengths = np.full(depths.shape, layer.thickness * self.UG2G / abs(cos(angle)))
+            sigmas = self.get_layer_straggling_batch(projectile, idx, e_current, pathLengths)
+            e_current = e_current - self.get_layer_energyloss_batch(projectile, idx, e_current, pathLengths) + rng.normal(0.0, 1.0, depths.shape) * sigmas
+            e_current = np.maximum(e_current, 0.0)
+
+        return e_initial - e_current*ap_u
@@ -0,0 +1,80 @@
+from .SPSPlot import SPSPlot, DEG2RAD
+from .SPSReaction import Reaction
+import numpy as np
+from numpy.typing import NDArray
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import copy
+
+#rho and focal plane offset for every level of one reaction over a grid of spectrograph settings
+#Arrays are indexed [beamEnergy, angle, magneticField, excitation] (kineticEnergy has no field axis, it does not depend on it)
+#Kinematically forbidden entries have a kinetic energy of INVALID_KINETIC_ENERGY and a rho and offset of 0.0, as in Reaction
+@dataclass
+class ScanResult:
+    rxnName: str
+    beamEnergies: NDArray[np.float64] #MeV
+    angles: NDArray[np.float64] #deg
+    magneticFields: NDArray[np.float64] #kG
+    excitations: NDArray[np.float64] #MeV
+    kineticEnergy: NDArray[np.float64] #MeV
+    rho: NDArray[np.float64] #cm
+    fpZ: NDArray[np.float64] #cm
+
+    #Flatten into columns of a tidy table, one row per (beam energy, angle, field, excitation)
+    def to_table(self) -> dict[str, NDArray]:
+        grids = np.meshgrid(self.beamEnergies, self.angles, self.magneticFields, self.excitations, indexing="ij")
+        return {
+            "Reaction": np.full(self.rho.size, self.rxnName),
+            "BeamEnergy(MeV)": grids[0].ravel(),
+            "Angle(deg)": grids[1].ravel(),
+            "BField(kG)": grids[2].ravel(),
+            "Excitation(MeV)": grids[3].ravel(),
+            "EjectileKE(MeV)": np.broadcast_to(self.kineticEnergy[:, :, np.newaxis, :], self.rho.shape).ravel(),
+            "Rho(cm)": self.rho.ravel(),
+            "Z-Offset(cm)": self.fpZ.ravel()
+        }
+
+#Worker task: kinematics of every level for one beam energy and every angle, evaluated at a field of 1 kG
+#rho and the focal plane offset are both inversely proportional to the field, so every other field is a rescaling of these
+def scan_beam_energy(rxn: Reaction, beamEnergy: float, angles: NDArray[np.float64], excitations: NDArray[np.float64]) -> tuple[NDArray[np.float64], NDArray[np.float64], NDArray[np.float64]]:
+    kineticEnergy = np.empty((len(angles), len(excitations)))
+    rho = np.empty((len(angles), len(excitations)))
+    fpZ = np.empty((len(angles), len(excitations)))
+    for index, angle in enumerate(angles):
+        rxn.update_parameters(beamEnergy, angle * DEG2RAD, 1.0)
+        kineticEnergy[index] = rxn.calculate_ejectile_KE_batch(excitations)
+        rho[index] = rxn.convert_ejectile_KE_2_rho_batch(kineticEnergy[index])
+        fpZ[index] = rxn.calculate_focal_plane_offset_batch(kineticEnergy[index])
+    return kineticEnergy, rho, fpZ
+
+#Evaluate every level of every reaction in sps over the grid of beam energies (MeV), angles (deg), and magnetic fields (kG, non-zero)
+#Work is split per (reaction, beam energy) across a process pool; maxWorkers=1 runs in this process instead
+#Returns a ScanResult per reaction, keyed as in SPSPlot.data. sps itself is not modified
+def scan_settings(sps: SPSPlot, beamEnergies: NDArray[np.float64], angles: NDArray[np.float64], magneticFields: NDArray[np.float64], maxWorkers: Optional[int] = None) -> dict[str, ScanResult]:
+    beamEnergies = np.atleast_1d(np.asarray(beamEnergies, dtype=np.float64))
+    angles = np.atleast_1d(np.asarray(angles, dtype=np.float64))
+    magneticFields = np.atleast_1d(np.asarray(magneticFields, dtype=np.float64))
+
+    tasks = []
+    for rxnName, datum in sps.data.items():
+        excitations = np.array([ex.excitation for ex in datum.excitations])
+        for beamEnergy in beamEnergies:
+            tasks.append((rxnName, datum.rxn, float(beamEnergy), angles, excitations))
+
+    if maxWorkers == 1:
+        #tasks change the reaction parameters; worker processes get copies anyway, so do the same here
+        results = [scan_beam_energy(copy.deepcopy(task[1]), *task[2:]) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+            results = list(executor.map(scan_beam_energy, *zip(*[task[1:] for task in tasks])))
+
+    scans: dict[str, ScanResult] = {}
+    inverseFields = 1.0 / magneticFields
+    for index, (rxnName, datum) in enumerate(sps.data.items()):
+        taskResults = results[index * len(beamEnergies):(index + 1) * len(beamEnergies)]
+        kineticEnergy = np.stack([result[0] for result in taskResults])
+        rho = np.stack([result[1] for result in taskResults])[:, :, np.newaxis, :] * inverseFields[np.newaxis, np.newaxis, :, np.newaxis]
+        fpZ = np.stack([result[2] for result in taskResults])[:, :, np.newaxis, :] * inverseFields[np.newaxis, np.newaxis, :, np.newaxis]
+        scans[rxnName] = ScanResult(rxnName, beamEnergies, angles, magneticFields, np.array([ex.excitation for ex in datum.excitations]), kineticEnergy, rho, fpZ)
+    return scans
@@ -1,13 +1,18 @@
-from .SPSReaction import *
-from .SPSTarget import *
-from .Fitter import *
-from .data.NuclearData import *
+from .SPSReaction import Reaction, RxnParameters
+from .SPSTarget import SPSTarget, TargetLayer
+from .Fitter import Fitter, FitPoint, FitResidual
+from .ModelSelection import SelectionCriterion, OrderSelectionResult, select_fit_order, get_candidate_orders, is_serial_selection
 from dataclasses import dataclass, field
+from concurrent.futures import Executor
 import numpy as np
+from numpy.typing import NDArray
+from numpy.polynomial import polynomial as poly
 from enum import Enum
+from typing import Optional
 
 INVALID_PEAK_ID: int = -1
 DEG2RAD: float = np.pi / 180.0
+RHO_DERIVATIVE_STEP: float = 1.0e-3 #cm, for the central difference dEx/drho
 
 class PeakType(Enum):
     CALIBRATION = "Calibration"
@@ -29,6 +34,32 @@ class Peak:
     rxnName: str = ""
     peakID: int = INVALID_PEAK_ID
 
+#rho and excitation of every output peak with their full covariance matrices, in the order of peakIDs
+#Outputs share the calibration, so their errors are correlated through the fit parameters; the position errors are independent
+@dataclass
+class OutputCovariance:
+    peakIDs: list[int]
+    rho: NDArray[np.float64] #cm
+    excitation: NDArray[np.float64] #MeV
+    rhoCovariance: NDArray[np.float64] #cm^2
+    excitationCovariance: NDArray[np.float64] #MeV^2
+
+    def get_excitation_correlation(self) -> NDArray[np.float64]:
+        errors = np.sqrt(np.diagonal(self.excitationCovariance))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.excitationCovariance / np.outer(errors, errors)
+
+#Number of items recalculated by Spanc since the counters were last reset
+@dataclass
+class RecalculationCounters:
+    reactions: int = 0 #reactions whose calibration peaks were recalculated
+    calibrations: int = 0 #calibration peaks (rho from excitation)
+    fits: int = 0
+    outputs: int = 0 #output peaks (rho and excitation from position)
+
+#Calculations follow the chain targets -> reactions -> calibrations -> fit -> outputs. Each change marks only what depends on it as dirty,
+#and the calculate_* methods only redo the dirty items: e.g. editing one reaction recalculates only its calibration peaks and outputs
+#(and the fit, as the calibration moved), while adding an output peak recalculates just that peak
 class Spanc:
     def __init__(self):
         self.targets: dict[str, SPSTarget] = {}
@@ -38,21 +69,103 @@ class Spanc:
         self.fitter : Fitter = Fitter()
         self.isFit: bool = False
 
+        self.dirtyCalibrations: set[int] = set()
+        self.dirtyOutputs: set[int] = set()
+        self.isFitDirty: bool = False
+        self.outputDerivatives: dict[int, float] = {} #dEx/drho of each output, MeV/cm
+        self.counters = RecalculationCounters()
+        self.outputCovariance: Optional[OutputCovariance] = None #from the last calculate_outputs, see calculate_output_covariance
+
+        self.executor: Optional[Executor] = None #process pool for large selections and resampling, made on first use
+        self.executorWorkers: Optional[int] = None
+
+    #sessions saved before the dependency tracking was added lack its attributes; start those from a clean state
+    def __setstate__(self, state: dict) -> None:
+        self.__init__()
+        self.__dict__.update(state)
+
+    #a process pool cannot be pickled (saving a session), it is made again when needed
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["executor"] = None
+        state["executorWorkers"] = None
+        return state
+
+    #Process pool shared by the calls of this session, so its start up cost is paid once. It is remade if maxWorkers changes,
+    #and can also be passed to CalibrationResampling.resample_calibration
+    def get_executor(self, maxWorkers: Optional[int] = None) -> Executor:
+        if self.executor is not None and self.executorWorkers != maxWorkers:
+            self.close()
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor #pulls in multiprocessing, only needed once a pool is used
+            self.executor = ProcessPoolExecutor(max_workers=maxWorkers)
+            self.executorWorkers = maxWorkers
+        return self.executor
+
+    #shut down the process pool, if one was made; call when done with the session
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.executorWorkers = None
+
+    def reset_counters(self) -> None:
+        self.counters = RecalculationCounters()
+
+    def mark_reaction_dirty(self, rxnName: str) -> None:
+        self.dirtyCalibrations.update(peak.peakID for peak in self.calibrations.values() if peak.rxnName == rxnName)
+        self.dirtyOutputs.update(peak.peakID for peak in self.outputs.values() if peak.rxnName == rxnName)
+
+    def mark_fit_dirty(self) -> None:
+        self.isFitDirty = True
+
     def set_fit_order(self, order: int) -> None:
+        if order != self.fitter.polynomialOrder:
+            self.mark_fit_dirty()
         self.fitter.set_polynomial_order(order)
 
+    #at least one degree of freedom is needed to fit
+    def can_fit(self) -> bool:
+        return len(self.calibrations) >= self.fitter.polynomialOrder + 2
+
+    #calibration peaks as fit data: position (with the statistical and systematic errors combined) vs. rho
+    def get_fit_data(self) -> list[FitPoint]:
+        return [FitPoint(peak.position, peak.rho, np.sqrt(peak.positionErrStat**2.0 + peak.positionErrSys**2.0), peak.rhoErr) for peak in self.calibrations.values()]
+
     #return fit data so that the data points can be drawn
-    def fit(self) -> list[FitPoint]:
-        fitData = [FitPoint(peak.position, peak.rho, np.sqrt(peak.positionErrStat**2.0 + peak.positionErrSys**2.0), peak.rhoErr) for peak in self.calibrations.values()]
-        self.fitter.run(data=fitData)
+    #Any outstanding calibration changes are applied first; refitting moves every output, so all of them become dirty
+    #warmStart starts from the previous fit (see Fitter.refit), which converges faster after small edits to the peaks
+    def fit(self, warmStart: bool = False) -> list[FitPoint]:
+        self.calculate_calibrations()
+        fitData = self.get_fit_data()
+        if warmStart:
+            self.fitter.refit(data=fitData)
+        else:
+            self.fitter.run(data=fitData)
         self.isFit = True
+        self.isFitDirty = False
+        self.dirtyOutputs.update(self.outputs.keys())
+        self.counters.fits += 1
         return fitData
 
+    #score every fit order up to maxOrder on the calibration peaks; the fit itself is unchanged, see set_fit_order
+    #Small selections are fit in this process; large ones use the session's process pool (see ModelSelection.is_serial_selection)
+    def select_fit_order(self, maxOrder: int, criterion: SelectionCriterion = SelectionCriterion.BIC, maxWorkers: Optional[int] = None) -> OrderSelectionResult:
+        data = self.get_fit_data()
+        isSerial = is_serial_selection(len(data), len(get_candidate_orders(len(data), maxOrder)), maxWorkers)
+        executor = None if isSerial else self.get_executor(maxWorkers)
+        return select_fit_order(data, maxOrder, criterion, executor=executor, maxWorkers=maxWorkers)
+
     def get_residuals(self) -> list[FitResidual]:
         return self.fitter.get_residuals()
 
     def add_target(self, targName: str, layers: list[TargetLayer]) -> None:
         self.targets[targName] = SPSTarget(layers, name=targName)
+        #if this replaces an existing target, the reactions using it must be pointed to the new one
+        for rxnName, rxn in self.reactions.items():
+            if rxn.targetMaterial.name == targName:
+                rxn.set_target(self.targets[targName])
+                self.mark_reaction_dirty(rxnName)
 
     def add_reaction(self, params: RxnParameters, targetName: str) -> None:
         if targetName not in self.targets:
@@ -66,64 +179,115 @@ class Spanc:
     def update_reaction_parameters(self, beamEnergy: float, spsAngle: float, magneticField: float, rxnName: str):
         if rxnName in self.reactions:
             rxn = self.reactions[rxnName]
-            rxn.params.beamEnergy = beamEnergy
-            rxn.params.spsAngle = spsAngle * DEG2RAD
-            rxn.params.magneticField = magneticField
+            rxn.update_parameters(beamEnergy, spsAngle * DEG2RAD, magneticField)
+            self.mark_reaction_dirty(rxnName)
 
+    #adding or editing a calibration peak calculates it right away, and only it; the fit is then out of date
     def add_calibration(self, data: Peak) -> None:
         if data.rxnName in self.reactions:
-            rxn = self.reactions[data.rxnName]
-            data.rho = rxn.convert_ejectile_KE_2_rho(rxn.calculate_ejectile_KE(data.excitation))
-            data.rhoErr = np.abs(rxn.convert_ejectile_KE_2_rho(rxn.calculate_ejectile_KE(data.excitation + data.excitationErr)) - data.rho)
             if data.peakID == INVALID_PEAK_ID:
                 data.peakID = len(self.calibrations)
             self.calibrations[data.peakID] = data
+            self.dirtyCalibrations.add(data.peakID)
+            self.calculate_calibrations()
         return
     
     def remove_calibration(self, data: Peak) -> bool:
         if data.peakID not in self.calibrations.keys():
             return False
         self.calibrations.pop(data.peakID)
+        self.dirtyCalibrations.discard(data.peakID)
+        self.mark_fit_dirty()
         return True
 
     def add_output(self, data: Peak) -> None:
         if data.peakID == INVALID_PEAK_ID:
             data.peakID = len(self.outputs)
         self.outputs[data.peakID] = data
+        self.dirtyOutputs.add(data.peakID)
         return
 
-    def calculate_output_urho(self, peak: Peak) -> float:
-        urho = 0.0
-        paramErrors = self.fitter.get_parameter_errors()
-        for i, paramErr in enumerate(paramErrors):
-            urho += (self.fitter.evaluate_param_derivative(peak.position, i) * paramErr)**2.0
-        urho += (self.fitter.evaluate_derivative(peak.position)*np.sqrt(peak.positionErrStat**2.0 + peak.positionErrSys**2.0))**2.0
-        return np.sqrt(urho)
+    #rho, excitation, dEx/drho, and FWHM of the dirty outputs (and any without a stored derivative), batched per reaction
+    def update_dirty_outputs(self) -> None:
+        dirty = [output for output in self.outputs.values() if output.peakID in self.dirtyOutputs or output.peakID not in self.outputDerivatives]
+        for rxnName, rxn in self.reactions.items():
+            outputs = [output for output in dirty if output.rxnName == rxnName]
+            if len(outputs) == 0:
+                continue
+            rho = self.fitter.evaluate(np.array([output.position for output in outputs]))
+            values = rxn.calculate_excitation_batch(np.concatenate((rho, rho + RHO_DERIVATIVE_STEP, rho - RHO_DERIVATIVE_STEP)))
+            derivatives = (values[len(outputs):2*len(outputs)] - values[2*len(outputs):]) / (2.0 * RHO_DERIVATIVE_STEP)
+            for index, output in enumerate(outputs):
+                output.rho = rho[index]
+                output.excitation = values[index]
+                self.outputDerivatives[output.peakID] = derivatives[index]
+                if output.positionFWHM == 0:
+                    output.excitationFWHM = 0
+                    output.excitationFWHMErr = 0
+                else:
+                    rhoLo = self.fitter.evaluate(output.position - output.positionFWHM * 0.5)
+                    rhoHi = self.fitter.evaluate(output.position + output.positionFWHM * 0.5)
+                    exLo = rxn.calculate_excitation(rhoLo)
+                    exHi = rxn.calculate_excitation(rhoHi)
+                    output.excitationFWHM = abs(exHi - exLo)
+                    output.excitationFWHMErr = output.positionFWHMErr/output.positionFWHM*output.excitationFWHM
+                self.dirtyOutputs.discard(output.peakID)
+                self.counters.outputs += 1
+
+    #Propagate the calibration parameter covariance and the position errors to every output at once
+    #The rho Jacobian is the Vandermonde matrix of the positions (parameters) plus the diagonal slope of the fit (positions).
+    #Each excitation depends only on its own rho, so the excitation Jacobian is that times dEx/drho, found by a central difference
+    #evaluated for all of the (dirty) outputs of a reaction in one batch by update_dirty_outputs
+    def propagate_output_covariance(self) -> OutputCovariance:
+        outputs = list(self.outputs.values())
+        beta = self.fitter.get_parameters()
+        positions = np.array([output.position for output in outputs])
+        positionErrors = np.array([np.sqrt(output.positionErrStat**2.0 + output.positionErrSys**2.0) for output in outputs])
+        rhoJacobian = poly.polyvander(positions, len(beta) - 1)
+        slopes = poly.polyval(positions, poly.polyder(beta)) if len(beta) > 1 else np.zeros(len(outputs))
+        rhoCovariance = rhoJacobian @ self.fitter.get_parameter_covariance() @ rhoJacobian.T + np.diag((slopes * positionErrors)**2.0)
+
+        excitationDerivative = np.array([self.outputDerivatives.get(output.peakID, 0.0) for output in outputs])
+        excitationCovariance = excitationDerivative[:, np.newaxis] * rhoCovariance * excitationDerivative[np.newaxis, :]
+        rho = np.array([output.rho for output in outputs])
+        excitation = np.array([output.excitation for output in outputs])
+        return OutputCovariance([output.peakID for output in outputs], rho, excitation, rhoCovariance, excitationCovariance)
+
+    #Output covariance from the last calculate_outputs. This does not recalculate anything: if the calibrations, the fit, or the outputs
+    #have changed since, it is None, and fit() (if the calibration changed) and calculate_outputs() must be called first
+    def calculate_output_covariance(self) -> Optional[OutputCovariance]:
+        if self.outputCovariance is None or self.isFitDirty or len(self.dirtyCalibrations) != 0 or len(self.dirtyOutputs) != 0:
+            return None
+        if self.outputCovariance.peakIDs != list(self.outputs.keys()):
+            return None
+        return self.outputCovariance
 
+    #Outputs are calculated with the current fit, which is not redone here: after changing the calibration, call fit() first
     def calculate_outputs(self) -> None:
         if self.isFit == False:
             return
+        self.update_dirty_outputs()
+        self.outputCovariance = self.propagate_output_covariance()
 
-        for output in self.outputs.values():
-            rxn = self.reactions[output.rxnName]
-            output.rho = self.fitter.evaluate(output.position)
-            output.rhoErr = self.calculate_output_urho(output)
-            output.excitation = rxn.calculate_excitation(output.rho)
-            output.excitationErr = np.abs(rxn.calculate_excitation(output.rho + output.rhoErr) - output.excitation)
-			
-            if output.positionFWHM == 0:
-                output.excitationFWHM = 0
-                output.excitationFWHMErr = 0
-            else:
-                rhoLo = self.fitter.evaluate(output.position - output.positionFWHM * 0.5)
-                rhoHi = self.fitter.evaluate(output.position + output.positionFWHM * 0.5)
-                exLo = rxn.calculate_excitation(rhoLo)
-                exHi = rxn.calculate_excitation(rhoHi)
-                output.excitationFWHM = abs(exHi - exLo)
-                output.excitationFWHMErr = output.positionFWHMErr/output.positionFWHM*output.excitationFWHM
+        rhoErrors = np.sqrt(np.diagonal(self.outputCovariance.rhoCovariance))
+        excitationErrors = np.sqrt(np.diagonal(self.outputCovariance.excitationCovariance))
+        for index, output in enumerate(self.outputs.values()):
+            output.rhoErr = rhoErrors[index]
+            output.excitationErr = excitationErrors[index]
 
+    #dirty calibrations are computed together per reaction, the excitations and excitations + errors in one batch
     def calculate_calibrations(self) -> None:
-        for calibration in self.calibrations.values():
-            rxn = self.reactions[calibration.rxnName]
-            calibration.rho = rxn.convert_ejectile_KE_2_rho(rxn.calculate_ejectile_KE(calibration.excitation))
-            calibration.rhoErr = np.abs(rxn.convert_ejectile_KE_2_rho(rxn.calculate_ejectile_KE(calibration.excitation + calibration.excitationErr)) - calibration.rho)
\ No newline at end of file
+        for rxnName, rxn in self.reactions.items():
+            peaks = [calibration for calibration in self.calibrations.values() if calibration.rxnName == rxnName and calibration.peakID in self.dirtyCalibrations]
+            if len(peaks) == 0:
+                continue
+            excitations = np.array([peak.excitation for peak in peaks])
+            excitationErrors = np.array([peak.excitationErr for peak in peaks])
+            rhos = rxn.convert_ejectile_KE_2_rho_batch(rxn.calculate_ejectile_KE_batch(np.concatenate((excitations, excitations + excitationErrors))))
+            for index, peak in enumerate(peaks):
+                peak.rho = rhos[index]
+                peak.rhoErr = np.abs(rhos[index + len(peaks)] - rhos[index])
+            self.counters.reactions += 1
+            self.counters.calibrations += len(peaks)
+            self.mark_fit_dirty()
+        self.dirtyCalibrations.clear()
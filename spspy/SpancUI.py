@@ -166,6 +166,10 @@ class SpancGUI(QMainWindow):
         self.fitTextGroup.setLayout(fitTextLayout)
         self.plotlayout.addWidget(self.fitTextGroup)
 
+    def closeEvent(self, event) -> None:
+        self.spanc.close()
+        super().closeEvent(event)
+
     def handle_save(self) -> None:
         fileName = QFileDialog.getSaveFileName(self, "Save Input","./","SPANC Files (*.spanc)")
         if fileName[0]:
@@ -183,6 +187,7 @@ class SpancGUI(QMainWindow):
         fileName = QFileDialog.getOpenFileName(self, "Open Input","./","SPANC Files (*.spanc)")
         if fileName[0]:
             with open(fileName[0], "rb") as openfile:
+                self.spanc.close()
                 self.spanc = pickle.load(openfile)
                 self.update_target_table()
                 self.update_reaction_table()
@@ -207,8 +212,7 @@ class SpancGUI(QMainWindow):
             self.spanc.calculate_calibrations()
             self.update_reaction_table()
             self.update_calibration_table()
-            self.spanc.calculate_outputs()
-            self.update_output_table()
+            self.update_outputs()
         return
 
     def handle_new_reaction(self) -> None:
@@ -226,9 +230,16 @@ class SpancGUI(QMainWindow):
             self.update_reaction_table()
             self.spanc.calculate_calibrations()
             self.update_calibration_table()
+            self.update_outputs()
+        return
+
+    #only refit (and redraw the fit) if the calibration changed, otherwise just bring the outputs up to date
+    def update_outputs(self) -> None:
+        if self.spanc.isFit and self.spanc.isFitDirty:
+            self.run_fit(warmStart=True)
+        else:
             self.spanc.calculate_outputs()
             self.update_output_table()
-        return
 
     def handle_new_calibration(self) -> None:
         calDia = PeakDialog(PeakType.CALIBRATION, self.spanc.reactions.keys(), self)
@@ -246,7 +257,7 @@ class SpancGUI(QMainWindow):
         if calDia.exec():
             self.update_calibration_table()
             if self.spanc.isFit == True:
-                self.handle_run_fit()
+                self.run_fit(warmStart=True)
         return
 
     def handle_new_output(self) -> None:
@@ -269,13 +280,17 @@ class SpancGUI(QMainWindow):
         self.spanc.set_fit_order(order)        
 
     def handle_run_fit(self) -> None:
+        self.run_fit()
+
+    #edits to the peaks of an existing fit refit with a warm start from it (see Spanc.fit), the fit button always fits from scratch
+    def run_fit(self, warmStart: bool = False) -> None:
         order = self.spanc.fitter.polynomialOrder
         npoints = len(self.spanc.calibrations)
         if npoints < (order + 2):
             print(f"Warning! Attempting to fit {npoints} data points with order {order} polyomial, too few degrees of freedom!")
             print(f"Increase number of data points to at minimum {order+2} to use a polynomial of this order.")
             return
-        fitData = self.spanc.fit()
+        fitData = self.spanc.fit(warmStart=warmStart)
         xArray, yArray, xErrArray, yErrArray = convert_fit_points_to_arrays(fitData)
         xMin = np.amin(xArray)
         xMax = np.amax(xArray)
@@ -0,0 +1,100 @@
+import numpy as np
+from numpy.typing import NDArray
+from pathlib import Path
+from typing import Optional
+import hashlib
+import os
+import sys
+import tempfile
+
+CACHE_DIR_ENV: str = "SPSPY_CACHE_DIR"
+DEFAULT_CACHE_SIZE_MAX: int = 256 * 1024 * 1024 #bytes
+CACHE_FILE_SUFFIX: str = ".npz"
+
+#User cache directory for spspy, which can be overridden with the SPSPY_CACHE_DIR environment variable
+def get_cache_directory() -> Path:
+    override = os.environ.get(CACHE_DIR_ENV, None)
+    if override:
+        return Path(override)
+    if sys.platform.startswith("win"):
+        return Path(os.environ.get("LOCALAPPDATA", Path.home() / "AppData" / "Local")) / "spspy" / "cache"
+    elif sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "spspy"
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "spspy"
+
+#Hash an arbitrary (repr-stable) description of some content into a cache key
+def generate_cache_key(content: object) -> str:
+    return hashlib.sha256(repr(content).encode("utf-8")).hexdigest()
+
+#Size bounded store of named numpy arrays, one compressed .npz file per key
+#Least recently used entries are evicted first: loading an entry refreshes its modification time, which orders the eviction
+#Failures to read or write are reported and otherwise ignored, the cache is only ever an accelerator
+class DiskCache:
+    def __init__(self, name: str, sizeMax: int = DEFAULT_CACHE_SIZE_MAX, directory: Optional[Path] = None):
+        self.directory = (directory if directory is not None else get_cache_directory()) / name
+        self.sizeMax = sizeMax
+
+    def get_path(self, key: str) -> Path:
+        return self.directory / f"{key}{CACHE_FILE_SUFFIX}"
+
+    def load(self, key: str) -> Optional[dict[str, NDArray]]:
+        path = self.get_path(key)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(path)
+            return arrays
+        except Exception as error:
+            print(f"Removing unreadable cache entry {path}: {error}")
+            path.unlink(missing_ok=True)
+            return None
+
+    #The temporary file is removed if the write fails, since get_entries (and so evict and clear) only see finished entries
+    def store(self, key: str, arrays: dict[str, NDArray]) -> None:
+        tempName = None
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            #write to a temporary file first so that other processes never see a partial entry
+            handle, tempName = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(handle, "wb") as tempFile:
+                np.savez_compressed(tempFile, **arrays)
+            os.replace(tempName, self.get_path(key))
+            tempName = None
+        except OSError as error:
+            print(f"Unable to write cache entry to {self.directory}: {error}")
+            return
+        finally:
+            if tempName is not None:
+                Path(tempName).unlink(missing_ok=True)
+        self.evict()
+
+    def get_entries(self) -> list[Path]:
+        if not self.directory.exists():
+            return []
+        return list(self.directory.glob(f"*{CACHE_FILE_SUFFIX}"))
+
+    def get_size(self) -> int:
+        return sum(path.stat().st_size for path in self.get_entries())
+
+    #Remove the least recently used entries until the cache fits within sizeMax
+    def evict(self) -> None:
+        entries = []
+        for path in self.get_entries():
+            try:
+                info = path.stat()
+                entries.append((info.st_mtime, info.st_size, path))
+            except OSError:
+                continue
+        entries.sort()
+        totalSize = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if totalSize <= self.sizeMax:
+                break
+            path.unlink(missing_ok=True)
+            totalSize -= size
+
+    def clear(self) -> None:
+        for path in self.get_entries():
+            path.unlink(missing_ok=True)
@@ -0,0 +1,156 @@
+from .DiskCache import get_cache_directory
+from .NuclearData import global_nuclear_data
+from pathlib import Path
+from typing import Optional
+import sqlite3
+import threading
+import csv
+
+LEVEL_DATABASE_NAME: str = "levels.sqlite"
+ENSDF_RECORD_LENGTH: int = 80
+ENSDF_ADOPTED_DATASET: str = "ADOPTED LEVELS"
+
+#Columns accepted for a CSV level export (matched case-insensitively). Energies are in keV, as in NuDat
+CSV_Z_COLUMNS: tuple[str, ...] = ("z",)
+CSV_A_COLUMNS: tuple[str, ...] = ("a",)
+CSV_N_COLUMNS: tuple[str, ...] = ("n",)
+CSV_ENERGY_COLUMNS: tuple[str, ...] = ("energy", "energy(kev)", "energy (kev)", "energy [kev]", "e(level)", "level energy", "elevel")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nuclei (Z INTEGER NOT NULL, A INTEGER NOT NULL, source TEXT NOT NULL, PRIMARY KEY (Z, A));
+CREATE TABLE IF NOT EXISTS levels (Z INTEGER NOT NULL, A INTEGER NOT NULL, energy REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS levels_nucleus ON levels (Z, A);
+"""
+
+#Parse an ENSDF level energy field (keV), e.g. "4438.91", "0.0", "1234 S" or "0+X". Offset levels (with an unknown X, Y, ...) are skipped
+def parse_ensdf_energy(field: str) -> Optional[float]:
+    text = field.strip().split(" ")[0]
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+#Local store of nuclear level energies, indexed by (Z, A), backed by an SQLite file
+#A nucleus is either present (possibly with no known levels) or missing; only missing nuclei need to be fetched from the network
+#Energies are stored in MeV
+class LevelDatabase:
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path if path is not None else get_cache_directory() / LEVEL_DATABASE_NAME
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            if str(self.path) != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def has_nucleus(self, Z: int, A: int) -> bool:
+        with self.lock:
+            return self.connect().execute("SELECT 1 FROM nuclei WHERE Z = ? AND A = ?", (Z, A)).fetchone() is not None
+
+    #Levels (MeV) of a nucleus in increasing energy, or None if the nucleus is not in the store
+    def get_levels(self, Z: int, A: int) -> Optional[list[float]]:
+        with self.lock:
+            connection = self.connect()
+            if connection.execute("SELECT 1 FROM nuclei WHERE Z = ? AND A = ?", (Z, A)).fetchone() is None:
+                return None
+            return [row[0] for row in connection.execute("SELECT energy FROM levels WHERE Z = ? AND A = ? ORDER BY energy", (Z, A))]
+
+    #Replace the levels (MeV) of a nucleus
+    def store_levels(self, Z: int, A: int, levels: list[float], source: str) -> None:
+        self.store_many({(Z, A): levels}, source)
+
+    #Replace the levels (MeV) of many nuclei, keyed by (Z, A), in one transaction
+    def store_many(self, levels: dict[tuple[int, int], list[float]], source: str) -> None:
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                for (Z, A), energies in levels.items():
+                    connection.execute("DELETE FROM levels WHERE Z = ? AND A = ?", (Z, A))
+                    connection.execute("INSERT OR REPLACE INTO nuclei (Z, A, source) VALUES (?, ?, ?)", (Z, A, source))
+                    connection.executemany("INSERT INTO levels (Z, A, energy) VALUES (?, ?, ?)", [(Z, A, energy) for energy in energies])
+
+    def remove_nucleus(self, Z: int, A: int) -> None:
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute("DELETE FROM levels WHERE Z = ? AND A = ?", (Z, A))
+                connection.execute("DELETE FROM nuclei WHERE Z = ? AND A = ?", (Z, A))
+
+    def get_nuclei(self) -> list[tuple[int, int]]:
+        with self.lock:
+            return [(row[0], row[1]) for row in self.connect().execute("SELECT Z, A FROM nuclei ORDER BY Z, A")]
+
+    #Load the adopted levels of every nucleus in an ENSDF file (80 column records). Returns the number of nuclei loaded
+    #Only level (L) records of ADOPTED LEVELS datasets are used, so decay and reaction datasets do not duplicate levels
+    def load_ensdf(self, path: str) -> int:
+        global_nuclear_data.load()
+        elementZ = {str(symbol).upper(): int(z) for symbol, z in zip(global_nuclear_data.symbols[global_nuclear_data.symbolIndex], global_nuclear_data.Z)}
+        levels: dict[tuple[int, int], list[float]] = {}
+        isAdopted = False
+        isNewDataset = True
+        with open(path) as ensdfFile:
+            for line in ensdfFile:
+                record = line.rstrip("\n").ljust(ENSDF_RECORD_LENGTH)
+                if record.strip() == "":
+                    isNewDataset = True
+                    continue
+                if isNewDataset:
+                    #identification record: the first record of a dataset
+                    isNewDataset = False
+                    isAdopted = record[9:39].strip().startswith(ENSDF_ADOPTED_DATASET)
+                    continue
+                if not isAdopted or record[5:9] != "  L ":
+                    continue
+                nucid = record[0:5]
+                try:
+                    A = int(nucid[0:3])
+                except ValueError:
+                    continue
+                Z = elementZ.get(nucid[3:5].strip().upper(), None)
+                energy = parse_ensdf_energy(record[9:19])
+                if Z is None or energy is None:
+                    continue
+                levels.setdefault((Z, A), []).append(energy / 1000.0) #convert to MeV
+        self.store_many(levels, f"ENSDF:{Path(path).name}")
+        return len(levels)
+
+    #Load levels from a CSV export (e.g. from NuDat) with one level per row and columns for Z, A (or N) and the level energy in keV
+    #Returns the number of nuclei loaded
+    def load_csv(self, path: str) -> int:
+        levels: dict[tuple[int, int], list[float]] = {}
+        with open(path, newline="") as csvFile:
+            reader = csv.DictReader(csvFile)
+            columns = {name.strip().lower(): name for name in (reader.fieldnames or [])}
+            zColumn = next((columns[name] for name in CSV_Z_COLUMNS if name in columns), None)
+            aColumn = next((columns[name] for name in CSV_A_COLUMNS if name in columns), None)
+            nColumn = next((columns[name] for name in CSV_N_COLUMNS if name in columns), None)
+            energyColumn = next((columns[name] for name in CSV_ENERGY_COLUMNS if name in columns), None)
+            if zColumn is None or (aColumn is None and nColumn is None) or energyColumn is None:
+                print(f"Unable to load levels from {path}: expected columns for Z, A (or N), and the level energy (keV)")
+                return 0
+            for row in reader:
+                try:
+                    Z = int(row[zColumn])
+                    A = int(row[aColumn]) if aColumn is not None else Z + int(row[nColumn])
+                    energy = float(row[energyColumn])
+                except (TypeError, ValueError):
+                    continue
+                levels.setdefault((Z, A), []).append(energy / 1000.0) #convert to MeV
+        self.store_many(levels, f"CSV:{Path(path).name}")
+        return len(levels)
+
+global_level_database = LevelDatabase()
+
+#Use a different level store, e.g. a shared one for a group or an in-memory one (Path(":memory:"))
+def set_level_database(path: Optional[Path]) -> None:
+    global_level_database.close()
+    global_level_database.path = path if path is not None else get_cache_directory() / LEVEL_DATABASE_NAME
@@ -0,0 +1,127 @@
+from .DiskCache import DiskCache, generate_cache_key
+from .NuclearData import global_nuclear_data
+from .LevelDatabase import LevelDatabase, global_level_database
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import numpy as np
+import threading
+
+NNDC_BASE_URL: str = "https://www.nndc.bnl.gov/nudat3"
+NNDC_LEVEL_PAGE: str = "getdatasetClassic.jsp"
+REQUEST_TIMEOUT: float = 30.0 #s
+DEFAULT_FETCH_WORKERS: int = 8
+
+#Extract the level energies (MeV) from a NuDat level page
+def parse_level_page(content: bytes) -> list[float]:
+    import lxml.html as xhtml
+    levels = []
+    text = ''
+    contents = xhtml.fromstring(content)
+    tables = contents.xpath("//table")
+    rows = tables[2].xpath("./tr")
+    for row in rows[1:-2]:
+        entries = row.xpath("./td")
+        if len(entries) != 0:
+            entry = entries[0]
+            data = entry.xpath("./a")
+            if len(data) == 0:
+                text = entry.text
+            else:
+                text = data[0].text
+            text = text.replace('?', '')
+            text = text.replace('\xa0\xa0≈','')
+            levels.append(float(text)/1000.0) #convert to MeV
+    return levels
+
+#Fetches NuDat level pages for many nuclei at once over a shared, pooled HTTP session
+#Responses are kept in a disk cache along with their ETag/Last-Modified validators, so repeated fetches are conditional requests
+#which the server can answer with 304 Not Modified. The base URL can point at any server with the same pages (e.g. a local mirror)
+class LevelFetcher:
+    def __init__(self, baseUrl: str = NNDC_BASE_URL, maxWorkers: int = DEFAULT_FETCH_WORKERS, cache: Optional[DiskCache] = None, database: Optional[LevelDatabase] = None):
+        self.baseUrl = baseUrl.rstrip("/")
+        self.maxWorkers = maxWorkers
+        self.cache = cache if cache is not None else DiskCache("http")
+        self.database = database if database is not None else global_level_database
+        self.session = None #requests.Session, made on first use
+        self.requestCount: int = 0
+        self.notModifiedCount: int = 0
+        self.lock = threading.Lock() #guards the session creation and the counts, which happen in the fetch_many worker threads
+
+    #requests is only imported here, so spspy can be used without it as long as no levels are fetched
+    def get_session(self):
+        import requests as req
+        with self.lock:
+            if self.session is None:
+                self.session = req.Session()
+                adapter = req.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.maxWorkers)
+                self.session.mount("http://", adapter)
+                self.session.mount("https://", adapter)
+            return self.session
+
+    def close(self) -> None:
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def get_url(self, Z: int, A: int) -> str:
+        return f"{self.baseUrl}/{NNDC_LEVEL_PAGE}?nucleus={global_nuclear_data.get_data(Z, A).isotopicSymbol}&unc=nds"
+
+    #Body of the page at url, revalidating a cached copy with a conditional GET when there is one
+    def get_page(self, url: str) -> bytes:
+        cacheKey = generate_cache_key(("http", url))
+        cached = self.cache.load(cacheKey) if self.cache is not None else None
+        headers = {}
+        if cached is not None:
+            if str(cached["etag"]):
+                headers["If-None-Match"] = str(cached["etag"])
+            if str(cached["lastModified"]):
+                headers["If-Modified-Since"] = str(cached["lastModified"])
+
+        response = self.get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        isNotModified = response.status_code == 304 and cached is not None
+        with self.lock:
+            self.requestCount += 1
+            if isNotModified:
+                self.notModifiedCount += 1
+        if isNotModified:
+            return cached["content"].tobytes()
+        response.raise_for_status()
+
+        etag = response.headers.get("ETag", "")
+        lastModified = response.headers.get("Last-Modified", "")
+        if self.cache is not None and (etag or lastModified):
+            self.cache.store(cacheKey, {"content": np.frombuffer(response.content, dtype=np.uint8), "etag": np.array(etag), "lastModified": np.array(lastModified)})
+        return response.content
+
+    #Fetch the levels (MeV) of one nucleus
+    def fetch(self, Z: int, A: int) -> list[float]:
+        return parse_level_page(self.get_page(self.get_url(Z, A)))
+
+    #Fetch the levels (MeV) of many nuclei concurrently, keyed by (Z, A). Nuclei which fail to fetch are reported and left out
+    def fetch_many(self, nuclei: list[tuple[int, int]]) -> dict[tuple[int, int], list[float]]:
+        nuclei = list(dict.fromkeys(nuclei))
+        if len(nuclei) == 0:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.maxWorkers, len(nuclei))) as executor:
+            futures = {nucleus: executor.submit(self.fetch, *nucleus) for nucleus in nuclei}
+        levels = {}
+        for (Z, A), future in futures.items():
+            try:
+                levels[(Z, A)] = future.result()
+            except Exception as error:
+                print(f"Unable to fetch levels of {global_nuclear_data.get_data(Z, A).isotopicSymbol} from {self.baseUrl}: {error}")
+        return levels
+
+    #Fetch every nucleus missing from the level store and add it to the store. Returns the nuclei which were added
+    def populate(self, nuclei: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        missing = [nucleus for nucleus in dict.fromkeys(nuclei) if not self.database.has_nucleus(*nucleus)]
+        levels = self.fetch_many(missing)
+        self.database.store_many(levels, self.baseUrl)
+        return list(levels.keys())
+
+global_level_fetcher = LevelFetcher()
+
+#Point the global fetcher at a different server (e.g. a mirror, or a local test server)
+def set_level_fetcher_url(baseUrl: str) -> None:
+    global_level_fetcher.close()
+    global_level_fetcher.baseUrl = baseUrl.rstrip("/")
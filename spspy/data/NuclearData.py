@@ -1,7 +1,11 @@
+from .DiskCache import DiskCache, generate_cache_key
 import numpy as np
-import requests as req
-import lxml.html as xhtml
+from numpy.typing import NDArray
 from dataclasses import dataclass
+from typing import Optional
+import hashlib
+import os
+import threading
 
 PATH_TO_MASSFILE = "./etc/amdc2016_mass.txt"
 
@@ -23,55 +27,181 @@ class NucleusData:
 def generate_nucleus_id(z: np.uint32, a: np.uint32) -> np.uint32 :
     return z*z + z + a if z > a else a*a + z
 
+#Columns of the mass table, one row per nucleus. mass is the nuclear (not atomic) mass in MeV
+MASS_TABLE_DTYPE = np.dtype([("Z", np.int32), ("A", np.int32), ("mass", np.float64), ("elementSymbol", "U3")])
+
+#Parse the AME mass file into a structured array with MASS_TABLE_DTYPE
+def parse_mass_file(path: str) -> NDArray:
+    rows = []
+    with open(path) as massfile:
+        massfile.readline()
+        massfile.readline()
+        for line in massfile:
+            entries = line.split()
+            z = int(entries[1])
+            rows.append((z, int(entries[2]), (float(entries[4])  + 1.0e-6 * float(entries[5]) - float(z) * NuclearDataMap.ELECTRON_MASS) * NuclearDataMap.U2MEV, entries[3]))
+    return np.array(rows, dtype=MASS_TABLE_DTYPE)
+
+#Load the mass table of the given file from the binary cache, parsing (and caching) the text file only when it changed
+#The cache entry records the modification time and hash of the text it was built from. A matching mtime is trusted as is; otherwise the
+#file is hashed, so that touching the file does not force a rebuild
+def load_mass_table(path: str, cache: Optional[DiskCache]) -> NDArray:
+    if cache is None:
+        return parse_mass_file(path)
+    cacheKey = generate_cache_key(("mass_table", os.path.abspath(path), MASS_TABLE_DTYPE.descr))
+    mtime = os.stat(path).st_mtime_ns
+    arrays = cache.load(cacheKey)
+    if arrays is not None and int(arrays["sourceMtime"]) == mtime:
+        return arrays["table"]
+    with open(path, "rb") as massfile:
+        sourceHash = hashlib.sha256(massfile.read()).hexdigest()
+    if arrays is not None and str(arrays["sourceHash"]) == sourceHash:
+        table = arrays["table"]
+    else:
+        table = parse_mass_file(path)
+    cache.store(cacheKey, {"table": table, "sourceMtime": np.array(mtime, dtype=np.int64), "sourceHash": np.array(sourceHash)})
+    return table
+
+mass_table_cache: Optional[DiskCache] = DiskCache("nucleardata")
+
+#Set the cache used for the binary mass table; None always parses the text file
+def set_mass_table_cache(cache: Optional[DiskCache]) -> None:
+    global mass_table_cache
+    mass_table_cache = cache
+
+#The mass table is only read on the first lookup, and NucleusData are made as nuclei are requested,
+#so importing spspy (e.g. in a worker process) does not pay for the whole chart
 class NuclearDataMap:
     U2MEV: float = 931.493614838475
     ELECTRON_MASS: float = 0.000548579909
 
-    def __init__(self):
-        self.map = {}
-
-        with open(PATH_TO_MASSFILE) as massfile:
-            massfile.readline()
-            massfile.readline()
-            for line in massfile:
-                entries = line.split()
-                data = NucleusData()
-                data.Z = int(entries[1])
-                data.A = int(entries[2])
-                data.mass = (float(entries[4])  + 1.0e-6 * float(entries[5]) - float(data.Z) * self.ELECTRON_MASS) * self.U2MEV
-                data.elementSymbol = entries[3]
-                data.isotopicSymbol = f"{data.A}{entries[3]}"
-                data.prettyIsotopicSymbol = f"<sup>{data.A}</sup>{entries[3]}"
-                self.map[generate_nucleus_id(data.Z, data.A)] = data
+    def __init__(self, path: str = PATH_TO_MASSFILE):
+        self.path = path
+        self.table: Optional[NDArray] = None
+        self.index: dict[int, int] = {}
+        self.map: dict[int, NucleusData] = {}
+
+        #Columnar (struct-of-arrays) view of the table, filled by load
+        self.Z: NDArray[np.int32] = np.empty(0, dtype=np.int32)
+        self.A: NDArray[np.int32] = np.empty(0, dtype=np.int32)
+        self.mass: NDArray[np.float64] = np.empty(0, dtype=np.float64) #MeV
+        self.symbolIndex: NDArray[np.int32] = np.empty(0, dtype=np.int32) #into symbols
+        self.symbols: NDArray[np.str_] = np.empty(0, dtype="U3")
+        self.rowGrid: NDArray[np.int32] = np.full((1, 1), -1, dtype=np.int32) #row of each [Z, A], -1 where there is no data
+        self.loadLock = threading.Lock()
+
+    #get_data is called from worker threads (e.g. LevelFetcher.fetch_many), so the first load is done under a lock and everything is
+    #built before the table is set: a table which is not None means the index and the columns are ready
+    def load(self) -> None:
+        if self.table is not None:
+            return
+        with self.loadLock:
+            if self.table is not None:
+                return
+            table = load_mass_table(self.path, mass_table_cache)
+            ids = [generate_nucleus_id(z, a) for z, a in zip(table["Z"].tolist(), table["A"].tolist())]
+            symbols, symbolIndex = np.unique(table["elementSymbol"], return_inverse=True)
+            rowGrid = np.full((table["Z"].max() + 1, table["A"].max() + 1), -1, dtype=np.int32)
+            rowGrid[table["Z"], table["A"]] = np.arange(len(table), dtype=np.int32)
+
+            self.index = dict(zip(ids, range(len(ids))))
+            self.Z = table["Z"]
+            self.A = table["A"]
+            self.mass = table["mass"]
+            self.symbols = symbols
+            self.symbolIndex = symbolIndex.astype(np.int32)
+            self.rowGrid = rowGrid
+            self.table = table
+
+    #Table rows of the given nuclei, broadcast over Z and A; -1 where the nucleus is not in the table
+    def get_rows(self, z: NDArray[np.int64], a: NDArray[np.int64]) -> NDArray[np.int32]:
+        self.load()
+        z, a = np.broadcast_arrays(np.asarray(z, dtype=np.int64), np.asarray(a, dtype=np.int64))
+        valid = (z >= 0) & (a >= 0) & (z < self.rowGrid.shape[0]) & (a < self.rowGrid.shape[1])
+        rows = np.full(z.shape, -1, dtype=np.int32)
+        rows[valid] = self.rowGrid[z[valid], a[valid]]
+        return rows
+
+    #Nuclear masses (MeV) of the given nuclei, broadcast over Z and A; NaN where the nucleus is not in the table
+    def masses(self, z: NDArray[np.int64], a: NDArray[np.int64]) -> NDArray[np.float64]:
+        rows = self.get_rows(z, a)
+        return np.where(rows >= 0, self.mass[rows], np.nan)
+
+    #Isotopic symbols (e.g. 12C) of the given nuclei, empty where the nucleus is not in the table
+    def isotopic_symbols(self, z: NDArray[np.int64], a: NDArray[np.int64]) -> NDArray[np.str_]:
+        rows = self.get_rows(z, a)
+        symbols = np.where(rows >= 0, self.symbols[self.symbolIndex[rows]], "")
+        return np.where(rows >= 0, np.char.add(np.broadcast_to(a, rows.shape).astype(str), symbols), "")
 
     def get_data(self, z: np.uint32, a: np.uint32) -> NucleusData:
-        return self.map[generate_nucleus_id(z, a)]
+        nucleusID = generate_nucleus_id(z, a)
+        data = self.map.get(nucleusID, None)
+        if data is not None:
+            return data
+        self.load()
+        row = self.table[self.index[nucleusID]]
+        data = NucleusData()
+        data.Z = int(row["Z"])
+        data.A = int(row["A"])
+        data.mass = float(row["mass"])
+        data.elementSymbol = str(row["elementSymbol"])
+        data.isotopicSymbol = f"{data.A}{data.elementSymbol}"
+        data.prettyIsotopicSymbol = f"<sup>{data.A}</sup>{data.elementSymbol}"
+        self.map[nucleusID] = data
+        return data
 
 global_nuclear_data = NuclearDataMap()
 
+#Q-values (MeV) of target(projectile, ejectile)residual reactions, broadcast over all of the arguments
+#Nuclei missing from the mass table (or unphysical residuals) give NaN
+def calculate_q_values(zt: NDArray[np.int64], at: NDArray[np.int64], zp: NDArray[np.int64], ap: NDArray[np.int64], ze: NDArray[np.int64], ae: NDArray[np.int64]) -> NDArray[np.float64]:
+    zt, at, zp, ap, ze, ae = np.broadcast_arrays(*[np.asarray(value, dtype=np.int64) for value in (zt, at, zp, ap, ze, ae)])
+    return global_nuclear_data.masses(zt, at) + global_nuclear_data.masses(zp, ap) - global_nuclear_data.masses(ze, ae) - global_nuclear_data.masses(zt + zp - ze, at + ap - ae)
+
+#Beam energy (MeV) thresholds of the reactions, as in Reaction.calculate_ejectile_KE, for the given residual excitation (MeV)
+#Exothermic reactions have a threshold of 0; missing nuclei give NaN
+def calculate_thresholds(zt: NDArray[np.int64], at: NDArray[np.int64], zp: NDArray[np.int64], ap: NDArray[np.int64], ze: NDArray[np.int64], ae: NDArray[np.int64], excitation: NDArray[np.float64] = 0.0) -> NDArray[np.float64]:
+    zt, at, zp, ap, ze, ae = np.broadcast_arrays(*[np.asarray(value, dtype=np.int64) for value in (zt, at, zp, ap, ze, ae)])
+    rxnQ = calculate_q_values(zt, at, zp, ap, ze, ae) - excitation
+    projectileMass = global_nuclear_data.masses(zp, ap)
+    ejectileMass = global_nuclear_data.masses(ze, ae)
+    residualMass = global_nuclear_data.masses(zt + zp - ze, at + ap - ae)
+    threshold = -rxnQ * (ejectileMass + residualMass) / (ejectileMass + residualMass - projectileMass)
+    return np.where(np.isnan(rxnQ), np.nan, np.maximum(threshold, 0.0))
+
+#Whether get_excitations may fetch levels from NNDC for nuclei missing from the local level store
+allow_level_fetching: bool = True
+
+def set_level_fetching(isAllowed: bool) -> None:
+    global allow_level_fetching
+    allow_level_fetching = isAllowed
+
+#Levels (MeV) of a nucleus, from the local level store (see LevelDatabase)
+#Nuclei missing from the store are fetched from NNDC and added to it, unless fetching is disabled or fails, in which case there are no levels
 def get_excitations(Z: int, A: int) -> list[float]:
-    levels = []
-    text = ''
-    symbol = global_nuclear_data.get_data(Z, A).isotopicSymbol
-    site = req.get(f"https://www.nndc.bnl.gov/nudat3/getdatasetClassic.jsp?nucleus={symbol}&unc=nds")
-    contents = xhtml.fromstring(site.content)
-    tables = contents.xpath("//table")
-    rows = tables[2].xpath("./tr")
-    for row in rows[1:-2]:
-        entries = row.xpath("./td")
-        if len(entries) != 0:
-            entry = entries[0]
-            data = entry.xpath("./a")
-            if len(data) == 0:
-                text = entry.text
-            else:
-                text = data[0].text
-            text = text.replace('?', '')
-            text = text.replace('\xa0\xa0≈','')
-            levels.append(float(text)/1000.0) #convert to MeV
+    from .LevelDatabase import global_level_database
+    levels = global_level_database.get_levels(Z, A)
+    if levels is not None:
+        return levels
+    if not allow_level_fetching:
+        return []
+    try:
+        levels = fetch_excitations(Z, A)
+    except Exception as error:
+        print(f"Unable to fetch levels of {global_nuclear_data.get_data(Z, A).isotopicSymbol} from NNDC: {error}")
+        return []
+    global_level_database.store_levels(Z, A, levels, "NNDC")
     return levels
 
+#Fetch the levels (MeV) of a nucleus from NNDC (see LevelFetcher)
+def fetch_excitations(Z: int, A: int) -> list[float]:
+    from .LevelFetcher import global_level_fetcher
+    return global_level_fetcher.fetch(Z, A)
 
-                
-
-        
\ No newline at end of file
+#Fetch every one of the nuclei, given as (Z, A), missing from the local level store concurrently and add them to it,
+#so that the following get_excitations calls do not each wait on the network
+def prefetch_excitations(nuclei: list[tuple[int, int]]) -> None:
+    if not allow_level_fetching:
+        return
+    from .LevelFetcher import global_level_fetcher
+    global_level_fetcher.populate(nuclei)
@@ -0,0 +1,30 @@
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+IMPORT_TIME_BUDGET_MS: float = 500.0 #measured at ~200 ms cold, about half of it numpy
+HEAVY_MODULES: tuple[str, ...] = ("requests", "lxml", "PySide6", "matplotlib")
+
+#Cold import of the headless compute core in a fresh interpreter, timed by -X importtime (cumulative microseconds per module, on stderr)
+#Returns the cumulative import time of the module in ms and the heavy modules which were imported along with it
+def measure_cold_import(module: str) -> tuple[float, list[str]]:
+    check = f"import sys, {module}; print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", check], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    cumulative = None
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            cumulative = float(fields[1]) * 1.0e-3
+    assert cumulative is not None, f"{module} not found in the -X importtime output"
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative, loaded
+
+def test_spanc_cold_import_budget():
+    cumulative, _ = measure_cold_import("spspy.Spanc")
+    assert cumulative < IMPORT_TIME_BUDGET_MS, f"spspy.Spanc took {cumulative:.0f} ms to import, budget is {IMPORT_TIME_BUDGET_MS:.0f} ms"
+
+def test_compute_core_is_headless():
+    for module in ("spspy.Spanc", "spspy.SPSReaction", "spspy.SPSTarget", "spspy.Fitter"):
+        _, loaded = measure_cold_import(module)
+        assert loaded == [], f"importing {module} also imported {', '.join(loaded)}"
@@ -0,0 +1,31 @@
+import numpy as np
+import pycatima as catima
+import pytest
+from spspy.SPSTarget import SPSTarget, TargetLayer, validate_range_table, RANGE_TABLE_TOLERANCE, ENERGY_STOPPED_MIN
+from spspy.RangeTable import build_range_table, RANGE_TABLE_ENERGY_MAX
+from spspy.data.NuclearData import global_nuclear_data
+
+VALIDATION_ENERGIES: int = 25
+#The reverse energy loss needs the entrance energy to be in the table as well, so the top of the range is kept clear of RANGE_TABLE_ENERGY_MAX
+#(500 MeV/u is still far above anything the SPS sees)
+VALIDATION_ENERGY_MAX: float = 0.5 * RANGE_TABLE_ENERGY_MAX #MeV/u
+
+#(projectile Z, A), layer compound list, layer thickness (ug/cm^2): a thin and a thick single element layer, and a compound of light and heavy elements
+CASES = [
+    ((1, 2), [(6, 12, 1)], 50.0),
+    ((1, 1), [(6, 12, 1)], 1000.0),
+    ((2, 4), [(8, 16, 1), (73, 181, 1)], 200.0),
+]
+
+@pytest.mark.parametrize("projectileZA, compounds, thickness", CASES)
+def test_range_table_matches_integrator(projectileZA, compounds, thickness):
+    zp, ap = projectileZA
+    target = SPSTarget([TargetLayer(compounds, thickness)])
+    material = target.get_layer_material(0)
+    material.thickness(thickness * SPSTarget.UG2G)
+    projectile = catima.Projectile(global_nuclear_data.get_data(zp, ap).mass * SPSTarget.MEV2U, zp)
+    table = build_range_table(catima.Projectile(projectile.A(), projectile.Z()), material)
+
+    energies = np.geomspace(ENERGY_STOPPED_MIN, VALIDATION_ENERGY_MAX, VALIDATION_ENERGIES)
+    deviation = validate_range_table(table, projectile, material, energies)
+    assert deviation < RANGE_TABLE_TOLERANCE, f"range table deviates from the integrator by {deviation:.2e}, tolerance is {RANGE_TABLE_TOLERANCE:.0e}"